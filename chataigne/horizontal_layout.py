@@ -65,8 +65,14 @@ def write_style():
 
 
 @contextmanager
-def st_horizontal():
-    write_style()
+def st_horizontal(style: bool = True):
+    """Lay out the elements created inside the context in a row.
+
+    Pass style=False if write_style() was already called earlier in the script run,
+    to avoid sending the same <style> block for every row.
+    """
+    if style:
+        write_style()
 
     with st.container():
         st.markdown('<span class="hide-element horizontal-marker"></span>', unsafe_allow_html=True)
@@ -1,119 +1,341 @@
-import json
+import asyncio
+import functools
+import hashlib
+import inspect
+import re
 import time
-
-import anthropic
-import openai
-from openai.types.chat import ChatCompletionSystemMessageParam
+from collections import OrderedDict
+from contextlib import aclosing
+from typing import TYPE_CHECKING, Any, AsyncGenerator, cast
 
 from .messages import AnyMessagePart, MessageHistory, TextMessage, ToolRequestMessage
 from .tool import Tool
+from .utils import json_dumps, json_loads, run_sync
+
+if TYPE_CHECKING:
+    import anthropic
+    import openai
+    from anthropic.types import MessageParam, ToolParam
+
+
+# Answers to batched questions, see LLM.batch_call().
+BATCH_ANSWER_RE = re.compile(r"A\[(\d+)\]:\s*(.*?)(?=\nA\[\d+\]:|\Z)", re.DOTALL)
+
+
+# The SDKs are imported only when first needed, as they are slow to import.
+
+
+@functools.cache
+def openai_client() -> "openai.AsyncOpenAI":
+    """Client shared by all OpenAI models and sessions, so that its connections stay warm."""
+    import openai
+
+    return openai.AsyncOpenAI()
+
+
+@functools.cache
+def anthropic_client() -> "anthropic.AsyncAnthropic":
+    """Client shared by all Anthropic models and sessions, so that its connections stay warm."""
+    import anthropic
+
+    return anthropic.AsyncAnthropic()
 
 
 class LLM:
+    """A chat model.
+
+    Subclasses implement _generate(), or _stream() to also stream their text.
+    Models written against the older contract, which override __call__ only, still work,
+    whether their __call__ is sync or async: their answer is then streamed as a whole.
+    Such a __call__ must not call super().
+    """
+
     def __init__(
         self,
         nice_name: str,
         model_name: str,
+        cache: bool = False,
+        cache_size: int = 256,
     ):
         self.nice_name = nice_name
         self.model_name = model_name
+        # Off by default, as it would hide the randomness of the answers.
+        self.cache = cache
+        self.cache_size = cache_size
+        self._cached_answers: OrderedDict[bytes, list[AnyMessagePart]] = OrderedDict()
 
-    def __call__(
+    async def __call__(
         self, system: str, messages: MessageHistory, tools: list[Tool]
     ) -> list[AnyMessagePart]:
-        raise NotImplementedError()
+        """Generate the next parts of the conversation."""
+        return [
+            part async for part in self.stream(system, messages, tools) if not isinstance(part, str)
+        ]
 
+    async def stream(
+        self, system: str, messages: MessageHistory, tools: list[Tool]
+    ) -> AsyncGenerator[str | AnyMessagePart, None]:
+        """Generate the next parts of the conversation, yielding the text as it arrives.
 
-class OpenAILLM(LLM):
-    def __init__(self, nice_name: str, model_name: str):
-        super().__init__(nice_name, model_name)
-        self.client = openai.OpenAI()
+        The text deltas (str) come first, followed by the complete parts.
+        If caching is enabled, identical calls are answered from the last cache_size
+        answers, without deltas.
+        """
+        # Filtered once here, so that providers and the cache key only see enabled tools.
+        tools = [tool for tool in tools if tool.enabled]
 
-    def __call__(
+        if not self.cache:
+            # aclosing() closes the provider's stream when our consumer stops early.
+            async with aclosing(self._stream(system, messages, tools)) as items:
+                async for item in items:
+                    yield item
+            return
+
+        key = self.cache_key(system, messages, tools)
+        if key in self._cached_answers:
+            self._cached_answers.move_to_end(key)
+            for part in self._cached_answers[key]:
+                # The parts end up in histories, where they can be edited.
+                yield part.model_copy(deep=True)
+            return
+
+        answer = []
+        async with aclosing(self._stream(system, messages, tools)) as items:
+            async for item in items:
+                if not isinstance(item, str):
+                    answer.append(item.model_copy(deep=True))
+                yield item
+
+        self._cached_answers[key] = answer
+        if len(self._cached_answers) > self.cache_size:
+            self._cached_answers.popitem(last=False)
+
+    async def _generate(
         self, system: str, messages: MessageHistory, tools: list[Tool]
     ) -> list[AnyMessagePart]:
-        answer = (
-            (
-                self.client.chat.completions.create(
-                    messages=[
-                        ChatCompletionSystemMessageParam(content=system, role="system"),
-                        *messages.to_openai(),
-                    ],  # type: ignore
-                    model=self.model_name,
-                    temperature=0.2,
-                    tools=[tool.to_openai() for tool in tools],
-                )
+        return [
+            part
+            async for part in self._stream(system, messages, tools)
+            if not isinstance(part, str)
+        ]
+
+    async def _stream(
+        self, system: str, messages: MessageHistory, tools: list[Tool]
+    ) -> AsyncGenerator[str | AnyMessagePart, None]:
+        cls = type(self)
+        if cls._generate is not LLM._generate:
+            parts = await self._generate(system, messages, tools)
+        elif cls.__call__ is not LLM.__call__:
+            parts = await self._call(system, messages, tools)
+        else:
+            # Otherwise _generate() and _stream() would call each other forever.
+            raise NotImplementedError(f"{cls.__name__} must implement _generate() or _stream().")
+        for part in parts:
+            yield part
+
+    async def _call(
+        self, system: str, messages: MessageHistory, tools: list[Tool]
+    ) -> list[AnyMessagePart]:
+        """Await __call__, which older models override with a sync method."""
+        parts = self(system, messages, tools)
+        if inspect.isawaitable(parts):
+            parts = await parts
+        return parts
+
+    def call_sync(
+        self, system: str, messages: MessageHistory, tools: list[Tool]
+    ) -> list[AnyMessagePart]:
+        """Blocking version of __call__, for code that doesn't run in an event loop."""
+        return run_sync(self._call(system, messages, tools))
+
+    async def batch_call(
+        self, system: str, histories: list[MessageHistory], tools: list[Tool]
+    ) -> list[list[AnyMessagePart]]:
+        """Answer many independent histories, packing single questions into one request.
+
+        Only histories made of a single user text can be packed. If there are tools,
+        or any history is longer, or the answer can't be parsed, each history is sent
+        on its own, concurrently.
+        """
+
+        def is_single_question(history: MessageHistory) -> bool:
+            return len(history) == 1 and isinstance(history[0], TextMessage) and history[0].is_user
+
+        if len(histories) > 1 and not tools and all(map(is_single_question, histories)):
+            questions = "\n".join(
+                f"Q[{i}]: {history[0].text}" for i, history in enumerate(histories, 1)
             )
-            .choices[0]
-            .message
+            prompt = f"{questions}\nAnswer each question as A[i]: <answer>, one after the other."
+            question = MessageHistory([TextMessage(text=prompt, is_user=True)])
+            parts = await self._call(system, question, [])
+            reply = "".join(part.text for part in parts if isinstance(part, TextMessage))
+            answers = {int(i): text.strip() for i, text in BATCH_ANSWER_RE.findall(reply)}
+            if set(answers) == set(range(1, len(histories) + 1)):
+                return [
+                    [TextMessage(text=answers[i], is_user=False)]
+                    for i in range(1, len(histories) + 1)
+                ]
+
+        return list(await asyncio.gather(*[self._call(system, h, tools) for h in histories]))
+
+    def cache_key(self, system: str, messages: MessageHistory, tools: list[Tool]) -> bytes:
+        key = hashlib.blake2b(digest_size=16)
+        for data in (
+            self.model_name,
+            system,
+            messages.model_dump_json(),
+            json_dumps([tool.to_anthropic() for tool in tools]),
+        ):
+            key.update(data.encode())
+            key.update(b"\0")
+        return key.digest()
+
+    def cache_clear(self):
+        self._cached_answers.clear()
+
+
+class OpenAILLM(LLM):
+    def __init__(self, nice_name: str, model_name: str, cache: bool = False, cache_size: int = 256):
+        super().__init__(nice_name, model_name, cache, cache_size)
+
+    @property
+    def client(self) -> "openai.AsyncOpenAI":
+        return openai_client()
+
+    async def _stream(
+        self, system: str, messages: MessageHistory, tools: list[Tool]
+    ) -> AsyncGenerator[str | AnyMessagePart, None]:
+        import openai
+
+        stream = await self.client.chat.completions.create(
+            messages=[
+                {"role": "system", "content": system},
+                *messages.to_openai(),
+            ],  # type: ignore
+            model=self.model_name,
+            temperature=0.2,
+            # OpenAI rejects an empty list of tools
+            tools=[tool.to_openai() for tool in tools] or openai.NOT_GIVEN,
+            stream=True,
         )
 
-        new_messages = []
-        if answer.content is not None:
-            if isinstance(answer.content, str):
-                new_messages.append(TextMessage(text=answer.content, is_user=False))
-            else:
-                new_messages.append(
-                    TextMessage(text=f"Unrecognized content type: {answer.content}", is_user=False)
-                )
-
-        if answer.tool_calls:
-            for tool_call in answer.tool_calls:
-                new_messages.append(
-                    ToolRequestMessage(
-                        name=tool_call.function.name,
-                        parameters=json.loads(tool_call.function.arguments),
-                        id=tool_call.id,
+        text = []
+        # Tool calls arrive in pieces, identified by their index.
+        tool_calls: dict[int, dict[str, str]] = {}
+        # Closed even when the consumer stops early, so that the connection goes back to
+        # the pool.
+        async with stream as chunks:
+            async for chunk in chunks:
+                if not chunk.choices:
+                    continue
+                delta = chunk.choices[0].delta
+
+                if delta.content:
+                    text.append(delta.content)
+                    yield delta.content
+
+                for call in delta.tool_calls or []:
+                    current = tool_calls.setdefault(
+                        call.index, {"id": "", "name": "", "arguments": ""}
                     )
-                )
+                    if call.id:
+                        current["id"] = call.id
+                    if call.function and call.function.name:
+                        current["name"] += call.function.name
+                    if call.function and call.function.arguments:
+                        current["arguments"] += call.function.arguments
 
-        return new_messages
+        if text:
+            yield TextMessage(text="".join(text), is_user=False)
+
+        for call in tool_calls.values():
+            yield ToolRequestMessage(
+                name=call["name"],
+                parameters=json_loads(call["arguments"] or "{}"),
+                id=call["id"],
+            )
 
 
 class AnthropicLLM(LLM):
-    def __init__(self, nice_name: str, model_name: str):
-        super().__init__(nice_name, model_name)
-        self.client = anthropic.Anthropic()
+    def __init__(
+        self,
+        nice_name: str,
+        model_name: str,
+        prompt_cache: bool = True,
+        cache: bool = False,
+        cache_size: int = 256,
+    ):
+        super().__init__(nice_name, model_name, cache, cache_size)
+        self.prompt_cache = prompt_cache
+
+    @property
+    def client(self) -> "anthropic.AsyncAnthropic":
+        return anthropic_client()
 
-    def __call__(
+    async def _stream(
         self, system: str, messages: MessageHistory, tools: list[Tool]
-    ) -> list[AnyMessagePart]:
+    ) -> AsyncGenerator[str | AnyMessagePart, None]:
+        import anthropic
+
+        # Plain dicts, as the cache marks are added to items of several TypedDicts.
+        # Anthropic rejects empty text blocks, so an empty prompt has no system block.
+        formated_system: list[dict[str, Any]] = [{"type": "text", "text": system}] if system else []
+        formated_messages = cast(list[dict[str, Any]], messages.to_anthropic())
+        formated_tools = cast(list[dict[str, Any]], [tool.to_anthropic() for tool in tools])
+        extra_headers = {}
 
-        answer = self.client.messages.create(
-            system=system,
-            messages=messages.to_anthropic(),
+        if self.prompt_cache:
+            # Mark the stable prefix (system prompt, tools and all but the latest turn)
+            # so that Anthropic can serve it from its prompt cache on the next turns.
+            if formated_system:
+                formated_system[-1] = with_cache_control(formated_system[-1])
+            if formated_tools:
+                formated_tools[-1] = with_cache_control(formated_tools[-1])
+            # The latest turn is the one most likely to be edited, so we don't cache it.
+            if len(formated_messages) >= 2:
+                message = formated_messages[-2]
+                content = list(message["content"])
+                content[-1] = with_cache_control(content[-1])
+                formated_messages[-2] = {**message, "content": content}
+            extra_headers["anthropic-beta"] = "prompt-caching-2024-07-31"
+
+        async with self.client.messages.stream(
+            system=formated_system or anthropic.NOT_GIVEN,  # type: ignore
+            messages=cast("list[MessageParam]", formated_messages),
             model=self.model_name,
             temperature=0.2,
             max_tokens=4096,
-            tools=[tool.to_anthropic() for tool in tools],
-        )
+            tools=cast("list[ToolParam]", formated_tools),
+            extra_headers=extra_headers,
+        ) as stream:
+            async for text in stream.text_stream:
+                yield text
+            answer = await stream.get_final_message()
 
-        new_messages = []
         for part in answer.content:
             if part.type == "text":
-                new_messages.append(TextMessage(text=part.text, is_user=False))
+                yield TextMessage(text=part.text, is_user=False)
             elif part.type == "tool_use":
                 assert isinstance(part.input, dict)
-                new_messages.append(
-                    ToolRequestMessage(name=part.name, parameters=part.input, id=part.id)
-                )
+                yield ToolRequestMessage(name=part.name, parameters=part.input, id=part.id)
             else:
-                new_messages.append(
-                    TextMessage(text=f"Unrecognized content type: {part.type}", is_user=False)
-                )
+                yield TextMessage(text=f"Unrecognized content type: {part.type}", is_user=False)
+
 
-        return new_messages
+def with_cache_control(block: dict[str, Any]) -> dict[str, Any]:
+    """Return a copy of an Anthropic block marked as the end of a cacheable prefix."""
+    return {**block, "cache_control": {"type": "ephemeral"}}
 
 
 class EchoLLM(LLM):
     def __init__(self):
         super().__init__("A Echo", "echo")
 
-    def __call__(
+    async def _generate(
         self, system: str, messages: MessageHistory, tools: list[Tool]
     ) -> list[AnyMessagePart]:
         last_message = messages[-1]
-        time.sleep(1)
+        await asyncio.sleep(1)
         if isinstance(last_message, TextMessage):
             return [
                 TextMessage(text=last_message.text, is_user=False),
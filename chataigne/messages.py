@@ -1,14 +1,35 @@
-import base64
-import itertools
-import json
+import functools
 from abc import ABC, abstractmethod
+from collections import Counter
 from io import BytesIO
-from typing import Annotated, Any, Literal
-
-import PIL.Image
-from anthropic.types import MessageParam
-from openai.types.chat.chat_completion_message_param import ChatCompletionMessageParam
-from pydantic import BaseModel, Field, RootModel
+from typing import (
+    TYPE_CHECKING,
+    Annotated,
+    Any,
+    Callable,
+    ClassVar,
+    KeysView,
+    Literal,
+    Mapping,
+    Self,
+    cast,
+)
+
+from pydantic import BaseModel, Field, TypeAdapter
+
+from .utils import json_dumps, lookup_by_type
+
+if TYPE_CHECKING:
+    from anthropic.types import MessageParam
+    from openai.types.chat.chat_completion_message_param import (
+        ChatCompletionMessageParam,
+    )
+
+try:
+    # SIMD accelerated, with the same API as the standard library
+    import pybase64 as base64
+except ImportError:
+    import base64
 
 __all__ = [
     "TextMessage",
@@ -19,9 +40,70 @@ __all__ = [
 ]
 
 
+def memoized[F: Callable[..., Any]](method: F) -> F:
+    """Cache the result of a method without arguments, see MessagePart.cached.
+
+    The cached value is shared between calls, so callers must not mutate it.
+    It is only recomputed when a field is assigned, not when it is mutated in place.
+    """
+
+    @functools.wraps(method)
+    def wrapper(self: "MessagePart"):
+        return self.cached(method.__name__, lambda: method(self))
+
+    return wrapper  # type: ignore
+
+
 class MessagePart(BaseModel, ABC):
+    """A part of a conversation.
+
+    The conversions of a part (to_openai(), to_anthropic()...) are cached and shared,
+    so they are read-only. Parts are edited by assigning their fields, which clears
+    the cache: part.parameters = {...}, not part.parameters["x"] = ...
+    """
+
     type: Any
 
+    def cached[T](self, key: str, compute: Callable[[], T]) -> T:
+        """Return compute(), cached on the instance until one of its fields is assigned."""
+        # Like functools.cached_property, the cache lives in __dict__, which pydantic
+        # ignores for equality and serialisation.
+        cache = vars(self).setdefault("_cache", {})
+        try:
+            return cache[key]
+        except KeyError:
+            value = cache[key] = compute()
+            return value
+
+    def __setattr__(self, name: str, value: Any):
+        super().__setattr__(name, value)
+        # Messages are edited by assigning fields (e.g. from the UI), so cached values are stale.
+        vars(self).pop("_cache", None)
+
+    def __eq__(self, other: Any) -> bool:
+        # Pydantic's fast path compares the whole __dict__, which holds the cache, and its
+        # fallback is slow. Only the fields matter: __dict__ holds nothing else but the cache.
+        if type(other) is not type(self):
+            return False if isinstance(other, BaseModel) else NotImplemented
+        mine, theirs = self.__dict__, other.__dict__
+        if "_cache" not in mine and "_cache" not in theirs:
+            return mine == theirs
+        for name in type(self).__pydantic_fields__:
+            if mine[name] != theirs[name]:
+                return False
+        return True
+
+    def model_copy(self, *, update: Mapping[str, Any] | None = None, deep: bool = False) -> Self:
+        copy = super().model_copy(update=update, deep=deep)
+        vars(copy).pop("_cache", None)
+        return copy
+
+    @property
+    @abstractmethod
+    def role(self) -> Literal["user", "assistant", "tool"]:
+        """The OpenAI role of the message, without building the whole message."""
+        raise NotImplementedError()
+
     @abstractmethod
     def to_openai(self):
         raise NotImplementedError()
@@ -42,31 +124,79 @@ class TextMessage(MessagePart):
     is_user: bool
     type: Literal["text"] = "text"
 
+    @property
+    def role(self):
+        return "user" if self.is_user else "assistant"
+
+    @memoized
     def to_openai(self):
         return {
-            "role": "user" if self.is_user else "assistant",
+            "role": self.role,
             "content": [{"type": "text", "text": self.text}],
         }
 
     to_anthropic = to_openai
 
 
+type ImageMediaType = Literal["image/png", "image/jpeg", "image/gif", "image/webp"]
+
+
 class ImageMessage(MessagePart):
     base_64: str
+    media_type: ImageMediaType = "image/png"
     type: Literal["image"] = "image"
 
-    @classmethod
-    def from_path(cls, path: str):
-        img = PIL.Image.open(path)
-        # Convert the image to PNG format
-        buffered = BytesIO()
-        img.save(buffered, format="PNG")
-
-        # Encode the image to base64
-        img_base64 = base64.b64encode(buffered.getvalue()).decode("utf-8")
-
-        return cls(base_64=img_base64)
+    # Formats accepted as is by both OpenAI and Anthropic, as named by PIL.
+    SUPPORTED_FORMATS: ClassVar[dict[str, ImageMediaType]] = {
+        "PNG": "image/png",
+        "JPEG": "image/jpeg",
+        "GIF": "image/gif",
+        "WEBP": "image/webp",
+    }
 
+    @classmethod
+    def from_path(cls, path: str, max_size: int | None = None):
+        """Load an image from disk.
+
+        Images in a supported format are sent with their original bytes. Other
+        formats are converted to PNG. If max_size is given, larger images are
+        downscaled so that their largest side is at most max_size pixels.
+        """
+        import PIL.Image  # Slow to import, and only needed here
+
+        # Opening only reads the header, the pixels are decoded only if we re-encode.
+        with PIL.Image.open(path) as img:
+            media_type = cls.SUPPORTED_FORMATS.get(img.format or "")
+            too_large = max_size is not None and max(img.size) > max_size
+
+            if media_type is not None and not too_large:
+                with open(path, "rb") as f:
+                    img_base64 = base64.b64encode(f.read()).decode("ascii")
+            else:
+                # max_size is checked again so that pyright knows it is an int.
+                if too_large and max_size is not None:
+                    img.thumbnail((max_size, max_size))
+                if media_type is None:
+                    media_type = "image/png"
+                with BytesIO() as buffered:
+                    img.save(buffered, format=media_type.removeprefix("image/").upper())
+                    # getbuffer() avoids copying the encoded image once more
+                    with buffered.getbuffer() as data:
+                        img_base64 = base64.b64encode(data).decode("ascii")
+
+        return cls(base_64=img_base64, media_type=media_type)
+
+    @property
+    def role(self):
+        return "user"
+
+    @property
+    @memoized
+    def data_url(self) -> str:
+        """The image as a data URL, built once as it copies the whole base64 string."""
+        return f"data:{self.media_type};base64,{self.base_64}"
+
+    @memoized
     def to_openai(self):
         return {
             "role": "user",
@@ -74,12 +204,13 @@ class ImageMessage(MessagePart):
                 {
                     "type": "image_url",
                     "image_url": {
-                        "url": "data:image/png;base64," + self.base_64,
+                        "url": self.data_url,
                     },
                 }
             ],
         }
 
+    @memoized
     def to_anthropic(self):
         return {
             "role": "user",
@@ -88,7 +219,7 @@ class ImageMessage(MessagePart):
                     "type": "image",
                     "source": {
                         "type": "base64",
-                        "media_type": "image/png",
+                        "media_type": self.media_type,
                         "data": self.base_64,
                     },
                 }
@@ -102,6 +233,17 @@ class ToolRequestMessage(MessagePart):
     id: str
     type: Literal["toolrequest"] = "toolrequest"
 
+    @property
+    def role(self):
+        return "assistant"
+
+    @property
+    @memoized
+    def arguments_json(self) -> str:
+        """The parameters as compact JSON, as OpenAI expects them."""
+        return json_dumps(self.parameters)
+
+    @memoized
     def to_openai(self):
         return {
             "role": "assistant",
@@ -109,11 +251,12 @@ class ToolRequestMessage(MessagePart):
                 {
                     "id": self.id,
                     "type": "function",
-                    "function": {"name": self.name, "arguments": json.dumps(self.parameters)},
+                    "function": {"name": self.name, "arguments": self.arguments_json},
                 }
             ],
         }
 
+    @memoized
     def to_anthropic(self):
         return {
             "role": "assistant",
@@ -135,6 +278,11 @@ class ToolOutputMessage(MessagePart):
     canceled: bool = False
     type: Literal["tooloutput"] = "tooloutput"
 
+    @property
+    def role(self):
+        return "tool"
+
+    @memoized
     def to_openai(self):
         return {
             "role": "tool",
@@ -143,6 +291,7 @@ class ToolOutputMessage(MessagePart):
             "tool_call_id": self.id,
         }
 
+    @memoized
     def to_anthropic(self):
         return {
             "role": "user",
@@ -158,14 +307,75 @@ class ToolOutputMessage(MessagePart):
 
 type AnyMessagePart = TextMessage | ImageMessage | ToolRequestMessage | ToolOutputMessage
 
+# Whether a part is sent by the user for Anthropic, looked up by type or the closest base
+# class: tool outputs are user messages there.
+ANTHROPIC_FROM_USER: dict[type[MessagePart], Callable[[Any], bool]] = {
+    TextMessage: lambda part: part.is_user,
+    ImageMessage: lambda part: True,
+    ToolRequestMessage: lambda part: False,
+    ToolOutputMessage: lambda part: True,
+}
+
+
+# Pydantic is only used at the (de)serialisation boundary of MessageHistory.
+message_list_adapter = TypeAdapter(list[Annotated[AnyMessagePart, Field(discriminator="type")]])
+
 
-class MessageHistory(RootModel[list[AnyMessagePart]]):
-    root: list[Annotated[AnyMessagePart, Field(discriminator="type")]]
+class MessageHistory:
+    """A list of messages, with conversions to the OpenAI and Anthropic formats.
+
+    It is a plain list: parts are not validated when added, only in model_validate.
+    The ids of the tool requests and outputs are indexed as parts are added and removed.
+    """
 
     def __init__(self, root: list[AnyMessagePart]):
-        super().__init__(root=root)
+        self.root = list(root)
+        self._request_ids: Counter[str] = Counter()
+        self._output_ids: Counter[str] = Counter()
+        for part in self.root:
+            self._track(part, 1)
+
+    def _track(self, part: AnyMessagePart, delta: int):
+        if isinstance(part, ToolRequestMessage):
+            ids = self._request_ids
+        elif isinstance(part, ToolOutputMessage):
+            ids = self._output_ids
+        else:
+            return
+        ids[part.id] += delta
+        if ids[part.id] <= 0:
+            del ids[part.id]
+
+    def tool_request_ids(self) -> KeysView[str]:
+        return self._request_ids.keys()
+
+    def tool_output_ids(self) -> KeysView[str]:
+        return self._output_ids.keys()
+
+    @classmethod
+    def model_validate(cls, obj: Any) -> "MessageHistory":
+        return cls(message_list_adapter.validate_python(obj))
+
+    @classmethod
+    def model_validate_json(cls, data: str | bytes) -> "MessageHistory":
+        # Parsed by pydantic-core directly into the parts, without intermediate dicts.
+        return cls(message_list_adapter.validate_json(data))
+
+    def model_dump(self, **kwargs) -> list[dict[str, Any]]:
+        return message_list_adapter.dump_python(self.root, **kwargs)
 
-    def __iter__(self):  # type: ignore
+    def model_dump_json(self, **kwargs) -> str:
+        return message_list_adapter.dump_json(self.root, **kwargs).decode()
+
+    def __repr__(self):
+        return f"MessageHistory({self.root!r})"
+
+    def __eq__(self, other):
+        if not isinstance(other, MessageHistory):
+            return NotImplemented
+        return self.root == other.root
+
+    def __iter__(self):
         return iter(self.root)
 
     def __getitem__(self, index):
@@ -179,93 +389,114 @@ class MessageHistory(RootModel[list[AnyMessagePart]]):
 
     def append(self, other: AnyMessagePart):
         self.root.append(other)
+        self._track(other, 1)
 
     def extend(self, other: list[AnyMessagePart]):
-        self.root.extend(other)
+        for part in other:
+            self.append(part)
 
     def remove(self, other: AnyMessagePart):
         self.root.remove(other)
+        self._track(other, -1)
 
     def pop(self, index: int):
-        return self.root.pop(index)
+        part = self.root.pop(index)
+        self._track(part, -1)
+        return part
 
     def index(self, value: AnyMessagePart):
         return self.root.index(value)
 
     def insert(self, index: int, value: AnyMessagePart):
         self.root.insert(index, value)
+        self._track(value, 1)
+
+    def to_openai(self) -> "list[ChatCompletionMessageParam]":
+        """The messages in OpenAI's format.
 
-    def to_openai(self) -> list[ChatCompletionMessageParam]:
+        They may hold the cached dicts of the parts, so copy them before modifying them.
+        """
         formated = []
         # For openai, we need to merge:
         # - an optional assistant TextMessage and the consecutive ToolRequestMessages into a single one
         # - a user TextMessage and subsequent ImageMessages from the same user into a single one
 
+        parts = self.root
+        n = len(parts)
         i = 0
-        while i < len(self):
-            message = self[i]
-
-            # Merge consecutive user text message and Image messages
-            if isinstance(message, TextMessage) and message.is_user:
-                new = message.to_openai()
-                i += 1
-                for attached_image in itertools.takewhile(
-                    lambda x: isinstance(x, ImageMessage), self[i:]
-                ):
-                    new = merge(new, attached_image.to_openai())
+        while i < n:
+            message = parts[i]
+            new = message.to_openai()
+            i += 1
+
+            if isinstance(message, TextMessage):
+                # User text is followed by its images, assistant text by its tool requests.
+                if message.is_user:
+                    joining, key = ImageMessage, "content"
+                else:
+                    joining, key = ToolRequestMessage, "tool_calls"
+
+                # The merged list is built at once, instead of copied for each part.
+                items = None
+                while i < n and isinstance(parts[i], joining):
+                    if items is None:
+                        items = list(new.get(key, []))
+                    items.extend(parts[i].to_openai()[key])
                     i += 1
-
-            # Merge an assistant message with subsequent tool requests
-            elif isinstance(message, TextMessage) and not message.is_user:
-                new = message.to_openai()
-                i += 1
-                for tool_request in itertools.takewhile(
-                    lambda x: isinstance(x, ToolRequestMessage), self[i:]
-                ):
-                    new = merge(new, tool_request.to_openai())
-                    i += 1
-
-            # Just add the message
-            else:
-                new = message.to_openai()
-                i += 1
+                if items is not None:
+                    new = {**new, key: items}
 
             formated.append(new)
 
         return formated
 
-    def to_anthropic(self) -> list[MessageParam]:
+    def to_anthropic(self) -> "list[MessageParam]":
+        """The messages in Anthropic's format.
+
+        They may hold the cached dicts of the parts, so copy them before modifying them.
+        """
         formated = []
 
         # For anthropic, we need to merge:
         # - all user messages (text and image) and tool outputs into a single message
         # - all other, ie: all assistant messages and tool requests into a single message
 
-        def is_user_message(x):
-            return (
-                (isinstance(x, TextMessage) and x.is_user)
-                or isinstance(x, ImageMessage)
-                or isinstance(x, ToolOutputMessage)
-            )
-
-        i = 0
-        while i < len(self):
-            message = self[i]
-
-            new = message.to_anthropic()
-            # Merge consecutive user text/image message and tool outputs
-            if is_user_message(message):
-                i += 1
-                for part in itertools.takewhile(is_user_message, self[i:]):
-                    new = merge(new, part.to_anthropic())
-                    i += 1
+        parts = self.root
+        # Most histories are only text: they are built directly, skipping the per-part
+        # dispatch and caches. Subclasses may override to_anthropic(), so they take the
+        # general path below.
+        if all(type(part) is TextMessage for part in parts):
+            texts = cast(list[TextMessage], parts)
+            from_user = None
+            for text in texts:
+                block = {"type": "text", "text": text.text}
+                if text.is_user == from_user:
+                    formated[-1]["content"].append(block)
+                else:
+                    from_user = text.is_user
+                    role = "user" if from_user else "assistant"
+                    formated.append({"role": role, "content": [block]})
+            return formated
+
+        # A single pass: each part either opens a new message or extends the open one.
+        # Messages are the cached dicts of their first part, copied only when extended.
+        from_user = None
+        copied = False
+        for part in parts:
+            is_from_user = lookup_by_type(ANTHROPIC_FROM_USER, type(part))
+            if is_from_user is None:
+                raise TypeError(f"Cannot convert {type(part).__name__} to an Anthropic message.")
+            part_from_user = is_from_user(part)
+            new = part.to_anthropic()
+            if formated and part_from_user == from_user:
+                if not copied:
+                    formated[-1] = {**formated[-1], "content": list(formated[-1]["content"])}
+                    copied = True
+                formated[-1]["content"].extend(new["content"])
             else:
-                i += 1
-                for part in itertools.takewhile(lambda x: not is_user_message(x), self[i:]):
-                    new = merge(new, part.to_anthropic())
-                    i += 1
-
-            formated.append(new)
+                formated.append(new)
+                copied = False
+            from_user = part_from_user
 
         return formated
 
@@ -275,22 +506,34 @@ def merge[T: (dict, list)](a: T, b: T) -> T:
     Merge two dictionaries or lists together:
     - If both are lists, concatenate them
     - If both are dictionaries, merge them recursively. If a key is present in both dictionaries, the value must be the same.
+
+    Neither a nor b is modified, but values that don't need merging are shared with the result.
     """
     if isinstance(a, list) and isinstance(b, list):
         return a + b
-    elif isinstance(a, dict) and isinstance(b, dict):
-        new = {}
-        for key in a.keys():
-            new[key] = a[key]
-        for key in b.keys():
-            if key in new and isinstance(new[key], (dict, list)):
-                new[key] = merge(new[key], b[key])
-            elif key in new:
-                assert (
-                    new[key] == b[key]
-                ), f"Conflict on key {key}: {new[key]} != {b[key]}.\n{a}\n{b}"
-            else:
-                new[key] = b[key]
-        return new
-    else:
+    elif not (isinstance(a, dict) and isinstance(b, dict)):
         raise ValueError(f"Cannot merge {a} and {b}")
+
+    new = dict(a)
+    # Nested dictionaries are merged with an explicit stack instead of recursive calls.
+    stack = [(new, b)]
+    while stack:
+        out, other = stack.pop()
+        for key, value in other.items():
+            if key not in out:
+                out[key] = value
+                continue
+
+            current = out[key]
+            if isinstance(current, list) and isinstance(value, list):
+                out[key] = current + value
+            elif isinstance(current, dict) and isinstance(value, dict):
+                out[key] = dict(current)
+                stack.append((out[key], value))
+            elif isinstance(current, (dict, list)):
+                raise ValueError(f"Cannot merge {current} and {value}")
+            else:
+                # Only checked in debug mode, python -O strips it
+                assert current == value, f"Conflict on key {key}: {current} != {value}.\n{a}\n{b}"
+
+    return new
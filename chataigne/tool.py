@@ -1,9 +1,15 @@
-from inspect import Parameter, signature
-from typing import Any, Callable
+import asyncio
+import weakref
+from inspect import Parameter, iscoroutinefunction, signature
+from typing import TYPE_CHECKING, Any, Callable, Mapping, Self
 
-from anthropic.types import ToolParam
-from openai.types.chat.chat_completion_tool_param import ChatCompletionToolParam
-from pydantic import BaseModel, create_model
+from pydantic import BaseModel, PrivateAttr, ValidationError, create_model
+
+from .utils import run_sync
+
+if TYPE_CHECKING:
+    from anthropic.types import ToolParam
+    from openai.types.chat.chat_completion_tool_param import ChatCompletionToolParam
 
 
 class Tool(BaseModel):
@@ -12,19 +18,44 @@ class Tool(BaseModel):
     pydantic_model: type[BaseModel]
     enabled: bool = True
 
+    # Serialisations of the tool, which don't depend on whether it is enabled.
+    _cache: dict[str, Any] = PrivateAttr(default_factory=dict)
+
+    def __setattr__(self, name: str, value: Any):
+        super().__setattr__(name, value)
+        if name in type(self).model_fields and name != "enabled":
+            self._cache.clear()
+
+    def model_copy(self, *, update: Mapping[str, Any] | None = None, deep: bool = False) -> Self:
+        copy = super().model_copy(update=update, deep=deep)
+        # The copy would share the cache, which doesn't match its fields after an update.
+        copy._cache = {}
+        return copy
+
+    def _cached(self, key: str, compute: Callable[[], Any]) -> Any:
+        try:
+            return self._cache[key]
+        except KeyError:
+            value = self._cache[key] = compute()
+            return value
+
     def shema(self) -> dict[str, Any]:
-        schema = self.pydantic_model.model_json_schema()
-        parameters = schema["properties"]
-        required = schema["required"]
+        return self._cached("shema", self._shema)
 
+    def _shema(self) -> dict[str, Any]:
+        schema = self.pydantic_model.model_json_schema()
+        # Pydantic omits "required" when all parameters have defaults.
         return {
             "type": "object",
-            "properties": parameters,
-            "required": required,
+            "properties": schema["properties"],
+            "required": schema.get("required", []),
         }
 
-    def to_openai(self) -> ChatCompletionToolParam:
-        data = {
+    def to_openai(self) -> "ChatCompletionToolParam":
+        return self._cached("openai", self._to_openai)
+
+    def _to_openai(self) -> "ChatCompletionToolParam":
+        tool: dict[str, Any] = {
             "type": "function",
             "function": {
                 "name": self.name,
@@ -33,9 +64,12 @@ class Tool(BaseModel):
             },
             "strict": True,
         }
-        return ChatCompletionToolParam(**data)
+        return tool  # type: ignore
+
+    def to_anthropic(self) -> "ToolParam":
+        return self._cached("anthropic", self._to_anthropic)
 
-    def to_anthropic(self) -> ToolParam:
+    def _to_anthropic(self) -> "ToolParam":
         return {
             "name": self.name,
             "description": self.description,
@@ -45,6 +79,16 @@ class Tool(BaseModel):
     def run(self, **kwargs) -> str:
         raise NotImplementedError()
 
+    async def arun(self, **kwargs) -> str:
+        """Run the tool from async code, in a thread so that it doesn't block the event loop."""
+        return await asyncio.to_thread(self.run, **kwargs)
+
+    def validate_arguments(self, arguments: dict[str, Any]) -> dict[str, Any]:
+        """Coerce the arguments of a call to the types of the pydantic model."""
+        validated = self.pydantic_model.model_validate(arguments)
+        # Attributes rather than model_dump(), to keep nested models as such.
+        return {name: getattr(validated, name) for name in self.pydantic_model.model_fields}
+
     @classmethod
     def from_function(cls, func: Callable) -> "Tool":
         FArgs = create_model_from_function(func)
@@ -52,10 +96,26 @@ class Tool(BaseModel):
             func.__doc__ is not None
         ), f"Function '{func.__name__}' must have a docstring explaining how to use it (for the LLM)"
 
+        # Invalid calls fail before reaching the function, with a message the LLM can act on.
         class CustomTool(cls):
             def run(self, **kwargs):
+                if iscoroutinefunction(func):
+                    return run_sync(self.arun(**kwargs))
+                try:
+                    kwargs = self.validate_arguments(kwargs)
+                except ValidationError as e:
+                    return f"Invalid arguments for {self.name}: {e}"
                 return str(func(**kwargs))
 
+            async def arun(self, **kwargs):
+                if not iscoroutinefunction(func):
+                    return await super().arun(**kwargs)
+                try:
+                    kwargs = self.validate_arguments(kwargs)
+                except ValidationError as e:
+                    return f"Invalid arguments for {self.name}: {e}"
+                return str(await func(**kwargs))
+
         return CustomTool(
             name=func.__name__,
             description=func.__doc__,
@@ -63,7 +123,21 @@ class Tool(BaseModel):
         )
 
 
+# Tools are registered again on every Streamlit rerun, usually with the same functions.
+# Weak keys, so that the functions of a rerun script (and their globals) can still be collected.
+_models_cache: weakref.WeakKeyDictionary[Callable, type[BaseModel]] = weakref.WeakKeyDictionary()
+
+
 def create_model_from_function(func) -> type[BaseModel]:
+    try:
+        return _models_cache[func]
+    except KeyError:
+        pass
+    except TypeError:
+        # Callables that can't be weakly referenced, like instances with __slots__ or some
+        # C callables, are not cached.
+        pass
+
     # Get the signature of the function
     sig = signature(func)
 
@@ -82,4 +156,9 @@ def create_model_from_function(func) -> type[BaseModel]:
 
     # Create and return the dynamic model
     name = func.__name__.capitalize() + "Args"
-    return create_model(name, **attributes)
+    model = create_model(name, **attributes)
+    try:
+        _models_cache[func] = model
+    except TypeError:
+        pass
+    return model
@@ -1,12 +1,53 @@
+import asyncio
+import atexit
 import os
+import weakref
 
-import requests
+import httpx
+
+from ..utils import background_loop, background_loop_started, run_sync
 
 BASE = "https://serv.amazingmarvin.com/api/"
 TOKEN = os.getenv("AMAZING_MARVIN_TOKEN")
 
+# Shared by all calls on the same event loop, so that the connection to Marvin's server is
+# reused. The connections of a client are bound to the loop that opened them.
+_clients: weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, httpx.AsyncClient] = (
+    weakref.WeakKeyDictionary()
+)
+
+
+def client() -> httpx.AsyncClient:
+    """Return the client of the running event loop, creating it if needed."""
+    loop = asyncio.get_running_loop()
+    try:
+        return _clients[loop]
+    except KeyError:
+        pass
+
+    # The clients of closed loops can't be used any more, and they keep their loop alive.
+    for old_loop in [old_loop for old_loop in _clients if old_loop.is_closed()]:
+        del _clients[old_loop]
+
+    new_client = _clients[loop] = httpx.AsyncClient(
+        base_url=BASE,
+        headers={"X-API-token": TOKEN} if TOKEN else {},
+        timeout=10.0,
+    )
+    return new_client
+
+
+@atexit.register
+def close_client():
+    # Only the background loop still runs at exit. No new thread can be started at
+    # shutdown, so it is only used if it already runs.
+    if background_loop_started():
+        loop_client = _clients.get(background_loop())
+        if loop_client is not None:
+            run_sync(loop_client.aclose())
+
 
-def add_marvin_task(title: str):
+async def add_marvin_task(title: str):
     """Add a task to the user's Amazing Marvin account.
 
     Amazing Marvin's markup is availaible to specify the task's properties.
@@ -23,16 +64,12 @@ def add_marvin_task(title: str):
         14:00 Take a nap ~20m +0d #Selfcare
     """
 
-    url = BASE + "addTask"
     data = {"title": title}
-    headers = {
-        "X-API-token": TOKEN,
-    }
-    response = requests.post(url, json=data, headers=headers)
+    response = await client().post("addTask", json=data)
     response.raise_for_status()
 
     return "Task added successfully! 📝"
 
 
 if __name__ == "__main__":
-    add_marvin_task("Buy milk #groceries +0d ~5m 18:00")
+    run_sync(add_marvin_task("Buy milk #groceries +0d ~5m 18:00"))
@@ -0,0 +1,123 @@
+import asyncio
+import json
+import re
+import threading
+from typing import Any, AsyncIterator, Coroutine, Iterator
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+__all__ = [
+    "background_loop",
+    "background_loop_started",
+    "run_sync",
+    "iter_sync",
+    "json_dumps",
+    "json_loads",
+    "lookup_by_type",
+]
+
+_loop: asyncio.AbstractEventLoop | None = None
+_loop_lock = threading.Lock()
+
+
+def background_loop() -> asyncio.AbstractEventLoop:
+    """Return the event loop shared by all sessions, which runs forever in a daemon thread.
+
+    Streamlit runs each script in its own thread, without an event loop. Running every
+    coroutine on the same long-lived loop (instead of a new one per asyncio.run) lets
+    async clients keep their connection pools between calls.
+    """
+    global _loop
+    with _loop_lock:
+        if _loop is None:
+            _loop = asyncio.new_event_loop()
+            threading.Thread(
+                target=_loop.run_forever, name="chataigne-event-loop", daemon=True
+            ).start()
+    return _loop
+
+
+def background_loop_started() -> bool:
+    """Whether background_loop() was already called, without starting it."""
+    return _loop is not None
+
+
+def run_sync[T](coro: Coroutine[Any, Any, T]) -> T:
+    """Run a coroutine on the background loop and block until it returns."""
+    loop = background_loop()
+    try:
+        running = asyncio.get_running_loop()
+    except RuntimeError:
+        running = None
+    if running is loop:
+        coro.close()
+        raise RuntimeError("run_sync() cannot be called from the background loop, await instead.")
+
+    return asyncio.run_coroutine_threadsafe(coro, loop).result()
+
+
+def iter_sync[T](iterator: AsyncIterator[T]) -> Iterator[T]:
+    """Iterate over an async iterator from sync code, stepping it on the background loop."""
+
+    async def next_item() -> T:
+        return await anext(iterator)
+
+    try:
+        while True:
+            try:
+                yield run_sync(next_item())
+            except StopAsyncIteration:
+                return
+    finally:
+        # Also when the consumer stops early, so that the iterator can clean up.
+        aclose = getattr(iterator, "aclose", None)
+        if aclose is not None:
+            run_sync(aclose())
+
+
+# orjson only handles integers of 64 bits, which have at most 19 digits in JSON.
+# Longer runs of digits may be larger integers, which orjson would read as floats.
+_LONG_DIGITS = re.compile(r"\d{19}")
+_LONG_DIGITS_BYTES = re.compile(rb"\d{19}")
+
+
+def json_dumps(obj: Any, indent: bool = False) -> str:
+    """Serialise to JSON, compact or indented by 2 spaces, using orjson when it is installed."""
+    if orjson is not None:
+        option = orjson.OPT_NON_STR_KEYS | (orjson.OPT_INDENT_2 if indent else 0)
+        try:
+            return orjson.dumps(obj, option=option).decode()
+        except orjson.JSONEncodeError:
+            # Integers beyond 64 bits, which the standard library handles.
+            pass
+    # Same output as orjson, for what orjson supports
+    if indent:
+        return json.dumps(obj, indent=2, ensure_ascii=False)
+    return json.dumps(obj, separators=(",", ":"), ensure_ascii=False)
+
+
+def json_loads(data: str | bytes) -> Any:
+    """Parse JSON, using orjson when it is installed."""
+    if orjson is not None:
+        if isinstance(data, bytes):
+            long_digits = _LONG_DIGITS_BYTES.search(data)
+        else:
+            long_digits = _LONG_DIGITS.search(data)
+        if long_digits is None:
+            return orjson.loads(data)
+    return json.loads(data)
+
+
+def lookup_by_type[T](table: dict[type, T], cls: type) -> T | None:
+    """Return the value for cls in a table keyed by types, or for its closest base class."""
+    try:
+        return table[cls]
+    except KeyError:
+        pass
+    for base in cls.__mro__[1:]:
+        if base in table:
+            return table[base]
+    return None
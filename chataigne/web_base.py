@@ -1,14 +1,16 @@
+import asyncio
+import functools
 import json
 from enum import StrEnum
 from pathlib import Path
-from typing import Callable
+from typing import Any, Callable, Iterator
 
 import pydantic
 import streamlit as st
 from streamlit_pills import pills as st_pills
 
-from .horizontal_layout import st_horizontal
-from .llms import LLM, AnthropicLLM, EchoLLM, OpenAILLM
+from .horizontal_layout import HORIZONTAL_STYLE, st_horizontal
+from .llms import LLM, MODELS, EchoLLM
 from .messages import (
     AnyMessagePart,
     ImageMessage,
@@ -18,12 +20,20 @@ from .messages import (
     ToolRequestMessage,
 )
 from .tool import Tool
+from .utils import iter_sync, json_dumps, lookup_by_type, run_sync
 
 CSS_FILE = Path(__file__).parent / "styles.css"
 
 
+@functools.cache
+def page_style() -> str:
+    """All the CSS of the page, in a single element that hides itself."""
+    return f"{HORIZONTAL_STYLE}<style>{CSS_FILE.read_text()}</style>"
+
+
 class Actions(StrEnum):
     ALLOW_AND_RUN = "✅ Allow and Run"
+    ALLOW_ALL_AND_RUN = "✅ Allow all and Run"
     DENY = "❌ Deny"
     EDIT = "✏️"
     DELETE = "🗑️"
@@ -34,6 +44,13 @@ class ChatBackend:
         self.tools: dict[str, Tool] = {}
         self.messages = messages
         self.model = model
+        # Subclasses can add their own actions.
+        self.action_handlers: dict[Actions | str, Callable[[int], None]] = {
+            Actions.ALLOW_AND_RUN: self._allow_and_run,
+            Actions.ALLOW_ALL_AND_RUN: self._allow_all_and_run,
+            Actions.DENY: self._deny,
+            Actions.DELETE: self._delete,
+        }
 
     def tool[T: Callable](self, tool_function: T) -> T:
         """Decorator to register a tool in the chat."""
@@ -41,6 +58,10 @@ class ChatBackend:
         if tool.name in self.tools:
             raise ValueError(f"A tool named {tool} is already registered.")
         else:
+            # Build the cached schemas now, so that a tool that can't be serialised fails
+            # when it is registered instead of during a generation.
+            tool.to_openai()
+            tool.to_anthropic()
             self.tools[tool.name] = tool
         return tool_function
 
@@ -53,16 +74,47 @@ class ChatBackend:
 
     def generate_answer(self) -> list[AnyMessagePart]:
         """Generates a new answer from the model and appends it to the messages."""
-        new_parts = self.model("Be straightforward.", self.messages, self.enabled_tools())
+        new_parts = self.model.call_sync("Be straightforward.", self.messages, self.enabled_tools())
         self.messages.extend(new_parts)
         return new_parts
 
-    def actions_for(self, part_index: int) -> list[Actions | str]:
+    def stream_answer(self) -> Iterator[str]:
+        """Like generate_answer(), but yields the text of the answer as it arrives.
+
+        The new parts are appended to the messages once the stream is exhausted.
+        """
+        new_parts = []
+        stream = self.model.stream("Be straightforward.", self.messages, self.enabled_tools())
+        for item in iter_sync(stream):
+            if isinstance(item, str):
+                yield item
+            else:
+                new_parts.append(item)
+        self.messages.extend(new_parts)
+
+    def actions_for(
+        self, part_index: int, pending_requests: int | None = None
+    ) -> list[Actions | str]:
+        """The actions offered for a part.
+
+        pending_requests is count_pending_tool_requests(), computed here if not given.
+        The UI passes it, so that it is computed once per render, not once per message.
+        """
         part = self.messages[part_index]
 
         if isinstance(part, ToolRequestMessage):
             if self.needs_processing(part_index):
-                return [Actions.ALLOW_AND_RUN, Actions.DENY, Actions.DELETE, Actions.EDIT]
+                actions: list[Actions | str] = [
+                    Actions.ALLOW_AND_RUN,
+                    Actions.DENY,
+                    Actions.DELETE,
+                    Actions.EDIT,
+                ]
+                if pending_requests is None:
+                    pending_requests = self.count_pending_tool_requests()
+                if pending_requests > 1:
+                    actions.insert(1, Actions.ALLOW_ALL_AND_RUN)
+                return actions
             else:
                 return [Actions.DELETE, Actions.EDIT]
         if isinstance(part, TextMessage):
@@ -77,57 +129,94 @@ class ChatBackend:
         # 1. It's a tool request which has no corresponding tool output.
         # 2. It's a user message that has no response yet.
         if isinstance(part, ToolRequestMessage):
-            return not any(
-                isinstance(p, ToolOutputMessage) and p.id == part.id for p in self.messages
-            )
+            return part.id not in self.messages.tool_output_ids()
         elif isinstance(part, TextMessage) and part.is_user:
             return index == len(self.messages) - 1
         else:
             return False
 
     def tool_requests_ids(self):
-        return {m.id for m in self.messages if isinstance(m, ToolRequestMessage)}
+        return self.messages.tool_request_ids()
 
     def tool_output_ids(self):
-        return {m.id for m in self.messages if isinstance(m, ToolOutputMessage)}
+        return self.messages.tool_output_ids()
 
-    def call_action(self, action: Actions | str, index: int):
-        part = self.messages[index]
+    def count_pending_tool_requests(self) -> int:
+        return len(self.tool_requests_ids() - self.tool_output_ids())
 
-        if action == Actions.ALLOW_AND_RUN:
-            assert isinstance(part, ToolRequestMessage)
-            tool = self.tools[part.name]
+    def pending_tool_requests(self) -> list[ToolRequestMessage]:
+        """Tool requests that have neither been run nor denied yet."""
+        done = self.tool_output_ids()
+        if not self.tool_requests_ids() - done:
+            return []
+        return [m for m in self.messages if isinstance(m, ToolRequestMessage) and m.id not in done]
 
-            out = tool.run(**part.parameters)
+    def run_tool_requests(self, requests: list[ToolRequestMessage]):
+        """Run the tool requests concurrently and insert each output after its request.
 
-            # Check there's not already an output for this request
-            assert part.id not in self.tool_output_ids()
-            index = self.messages.index(part)
-            self.messages.insert(
-                index + 1, ToolOutputMessage(id=part.id, name=tool.name, content=out)
+        If some tools raise, the outputs of the others are still added, and the first
+        exception is re-raised afterwards.
+        """
+
+        # Check there's not already an output for these requests
+        done = self.tool_output_ids()
+        assert not any(request.id in done for request in requests)
+
+        async def run_all() -> list[str | BaseException]:
+            return await asyncio.gather(
+                *[self.tools[r.name].arun(**r.parameters) for r in requests],
+                return_exceptions=True,
             )
 
-        elif action == Actions.DENY:
-            assert isinstance(part, ToolRequestMessage)
-            tool = self.tools[part.name]
-            self.messages.append(
-                ToolOutputMessage(
-                    id=part.id, name=tool.name, content="Tool call denied by user", canceled=True
-                )
+        outputs = run_sync(run_all())
+
+        for request, out in zip(requests, outputs):
+            if isinstance(out, BaseException):
+                continue
+            index = self.messages.index(request)
+            self.messages.insert(
+                index + 1, ToolOutputMessage(id=request.id, name=request.name, content=out)
             )
 
-        elif action == Actions.DELETE:
-            self.messages.pop(index)
+        for out in outputs:
+            if isinstance(out, BaseException):
+                raise out
 
-            # Delete tool output at the same time as the request
-            if isinstance(part, ToolRequestMessage):
-                for i, m in enumerate(self.messages):
-                    if isinstance(m, ToolOutputMessage) and m.id == part.id:
-                        self.messages.pop(i)
-                        break
+    def call_action(self, action: Actions | str, index: int):
+        try:
+            handler = self.action_handlers[action]
+        except KeyError:
+            raise NotImplementedError(action) from None
+        handler(index)
 
-        else:
-            raise NotImplementedError(action)
+    def _allow_and_run(self, index: int):
+        part = self.messages[index]
+        assert isinstance(part, ToolRequestMessage)
+        self.run_tool_requests([part])
+
+    def _allow_all_and_run(self, index: int):
+        self.run_tool_requests(self.pending_tool_requests())
+
+    def _deny(self, index: int):
+        part = self.messages[index]
+        assert isinstance(part, ToolRequestMessage)
+        self.messages.append(
+            ToolOutputMessage(
+                id=part.id, name=part.name, content="Tool call denied by user", canceled=True
+            )
+        )
+
+    def _delete(self, index: int):
+        part = self.messages.pop(index)
+
+        # Delete tool output at the same time as the request. It is inserted right after
+        # the request when run, but appended at the end when denied.
+        if isinstance(part, ToolRequestMessage) and part.id in self.tool_output_ids():
+            for i in range(index, len(self.messages)):
+                m = self.messages[i]
+                if isinstance(m, ToolOutputMessage) and m.id == part.id:
+                    self.messages.pop(i)
+                    break
 
     def needs_generation(self) -> bool:
         if not self.messages:
@@ -145,25 +234,39 @@ class ChatBackend:
 class WebChat(ChatBackend):
     def __init__(self, models: list[LLM] = []):
         if not models:
-            models = [
-                OpenAILLM("GPT 4o", "gpt-4o"),
-                OpenAILLM("GPT 4o Mini", "gpt-4o-mini"),
-                AnthropicLLM("Claude 3.5 Sonnet", "claude-3-5-sonnet-20240620"),
-                EchoLLM(),
-            ]
+            # The echo model answers without an API key, which helps when developing.
+            models = [*MODELS, EchoLLM()]
         self.available_models = models
-
-        messages = st.session_state.setdefault("messages", MessageHistory([]))
+        self.models_by_name = {model.nice_name: model for model in models}
+        if len(self.models_by_name) != len(models):
+            raise ValueError("Models must have distinct nice names.")
+        self.model_names = sorted(self.models_by_name)
+
+        messages = st.session_state.get("messages")
+        if messages is None:
+            messages = st.session_state["messages"] = MessageHistory([])
+        elif type(messages) is not MessageHistory:
+            # While developing, and the script reloads, the classes of the messages
+            # get out of sync, as they are redefined/reimported. Only then, we rebuild
+            # the history with the current classes.
+            messages = st.session_state["messages"] = MessageHistory.model_validate(
+                messages.model_dump()
+            )
         super().__init__(messages, models[0])
 
         self.tool_requests_containers: dict = {}  # {part.id: st.container}
-
-        # While developing, and the script reloads, the class of the messages
-        # get out of sync, as the class is redefined/reimported. This is a
-        # workaround to fix that.
-        classes = [TextMessage, ImageMessage, ToolRequestMessage, ToolOutputMessage]
-        for message in self.messages:
-            message.__class__ = next(c for c in classes if c.__name__ == message.__class__.__name__)
+        # {part.id: (part.arguments_json, markdown)}, kept in the session so that a tool
+        # request is formatted once, not on every rerun, and again when it is edited.
+        self.tool_requests_markdown: dict[str, tuple[str, str]] = st.session_state.setdefault(
+            "tool_requests_markdown", {}
+        )
+        # Looked up by type or the closest base class, once per message and rerun.
+        self.part_renderers: dict[type, Callable[[Any, Any], None]] = {
+            TextMessage: self.show_text,
+            ImageMessage: self.show_image,
+            ToolRequestMessage: self.show_tool_request,
+        }
+        self.action_handlers[Actions.EDIT] = self._edit
 
     def show_sidebar(self):
         with st.sidebar:
@@ -178,7 +281,7 @@ class WebChat(ChatBackend):
                 for tool in self.tools.values():
                     st.write(f"### {tool.name}")
                     st.write(tool.description)
-                    st.code(json.dumps(tool.to_openai(), indent=2), language="json")
+                    st.code(json_dumps(tool.to_openai(), indent=True), language="json")
 
             if st.button("Show messages history"):
 
@@ -186,12 +289,14 @@ class WebChat(ChatBackend):
                 def show_history():
                     kind = st_pills("Kind", ["Raw", "For OpenAI", "For Anthropic"])
 
+                    # st.json() takes the JSON as a string, which is faster to produce than
+                    # the dicts st.write() would serialise with the stdlib.
                     if kind == "Raw":
-                        st.write(self.messages.model_dump())
+                        st.json(self.messages.model_dump_json())
                     elif kind == "For OpenAI":
-                        st.write(self.messages.to_openai())
+                        st.json(json_dumps(self.messages.to_openai()))
                     elif kind == "For Anthropic":
-                        st.write(self.messages.to_anthropic())
+                        st.json(json_dumps(self.messages.to_anthropic()))
                     else:
                         raise ValueError(kind)
 
@@ -202,28 +307,26 @@ class WebChat(ChatBackend):
         st.title("Chataigne 🌰")
 
         if len(self.available_models) > 1:
-            models_by_name = {model.nice_name: model for model in self.available_models}
             model_name = st_pills(
                 "Model selection",
-                sorted(models_by_name.keys()),
+                self.model_names,
                 label_visibility="collapsed",
                 index=0,
                 key="model_pill",
             )
             # model_name = st.radio(
-            #     "Model selection", sorted(models_by_name.keys()), index=0, key="model_radio",
+            #     "Model selection", self.model_names, index=0, key="model_radio",
             #     horizontal=True)
-            self.model = models_by_name[model_name]
+            self.model = self.models_by_name[model_name]
 
         self.show_sidebar()
 
+        # The messages don't change while they are shown, actions run before the rerun.
+        pending_requests = self.count_pending_tool_requests()
         for i in range(len(self.messages)):
-            self.show_message(i)
+            self.show_message(i, pending_requests)
 
-        some_tool_was_not_run = any(
-            isinstance(m, ToolRequestMessage) and m.id not in self.tool_output_ids()
-            for m in self.messages
-        )
+        some_tool_was_not_run = pending_requests > 0
 
         st.chat_input(
             disabled=some_tool_was_not_run,
@@ -232,97 +335,117 @@ class WebChat(ChatBackend):
         )
 
         if self.needs_generation():
-            new = self.generate_answer()
-            for i in range(len(self.messages) - len(new), len(self.messages)):
-                self.show_message(i)
-
-    def call_action(self, action: Actions | str, index: int):
-        if action == Actions.EDIT:
-            message_to_be_edited = self.messages[index]
-            if isinstance(message_to_be_edited, TextMessage):
-
-                @st.dialog("Edit Message")
-                def edit_msg():
-                    with st.form(key="edit_message", border=False):
-                        edited_message = st.text_area(
-                            "edit_message",
-                            value=message_to_be_edited.text,
-                            label_visibility="collapsed",
-                        )
-                        with st_horizontal():
-                            if st.form_submit_button("Save changes"):
-                                self.messages[index].text = edited_message
-                                st.rerun()
-
-                edit_msg()
-            if isinstance(message_to_be_edited, ToolRequestMessage):
-                tool = self.tools[message_to_be_edited.name]
-
-                # can assume ai got the types right
-                @st.dialog("Edit Message")
-                def edit_msg():
-                    with st.form(key="edit_message", border=False):
-                        parameters = tool.pydantic_model.model_fields
-                        new_parameters = {}
-                        can_submit = True
-                        for key, expected_type in parameters.items():
-                            try:
-                                value = self.edit_one_parameter(
-                                    key, expected_type, message_to_be_edited.parameters[key]
-                                )
-                            except Exception as e:
-                                st.error(e)
-                                can_submit = False
-                            else:
-                                new_parameters[key] = value
-                        with st_horizontal():
-                            if st.form_submit_button("Save changes") and can_submit:
-                                self.messages[index].parameters = new_parameters
-                                st.rerun()
-
-                edit_msg()
-        else:
-            return super().call_action(action, index)
-
-    def show_message(self, index: int):
+            before = len(self.messages)
+            # The text is shown as it arrives, then replaced by the final parts and
+            # their actions.
+            placeholder = st.empty()
+            with placeholder.chat_message(name="assistant"):
+                st.write_stream(self.stream_answer())
+            placeholder.empty()
+            pending_requests = self.count_pending_tool_requests()
+            for i in range(before, len(self.messages)):
+                self.show_message(i, pending_requests)
+
+    def _edit(self, index: int):
+        message_to_be_edited = self.messages[index]
+        if isinstance(message_to_be_edited, TextMessage):
+
+            @st.dialog("Edit Message")
+            def edit_msg():
+                with st.form(key="edit_message", border=False):
+                    edited_message = st.text_area(
+                        "edit_message",
+                        value=message_to_be_edited.text,
+                        label_visibility="collapsed",
+                    )
+                    with st_horizontal(style=False):
+                        if st.form_submit_button("Save changes"):
+                            self.messages[index].text = edited_message
+                            st.rerun()
+
+            edit_msg()
+        if isinstance(message_to_be_edited, ToolRequestMessage):
+            tool = self.tools[message_to_be_edited.name]
+
+            # can assume ai got the types right
+            @st.dialog("Edit Message")
+            def edit_msg():
+                with st.form(key="edit_message", border=False):
+                    parameters = tool.pydantic_model.model_fields
+                    new_parameters = {}
+                    can_submit = True
+                    for key, expected_type in parameters.items():
+                        try:
+                            value = self.edit_one_parameter(
+                                key, expected_type, message_to_be_edited.parameters[key]
+                            )
+                        except Exception as e:
+                            st.error(e)
+                            can_submit = False
+                        else:
+                            new_parameters[key] = value
+                    with st_horizontal(style=False):
+                        if st.form_submit_button("Save changes") and can_submit:
+                            self.messages[index].parameters = new_parameters
+                            st.rerun()
+
+            edit_msg()
+
+    def show_message(self, index: int, pending_requests: int | None = None):
         message = self.messages[index]
         # We put tool outputs next to its tool.
         if isinstance(message, ToolOutputMessage):
             with self.tool_requests_containers[message.id]:
                 st.write(f"➡ {message.content}")
-                self.show_actions_for(index)
+                self.show_actions_for(index, pending_requests)
             return
 
         # Others have their own containers.
-        role = message.to_openai()["role"]
-        container = st.chat_message(name=role)
+        container = st.chat_message(name=message.role)
         with container:
-            if isinstance(message, TextMessage):
-                st.write(message.text)
-            elif isinstance(message, ImageMessage):
-                st.warning("Image messages are not supported yet.")
-            elif isinstance(message, ToolRequestMessage):
-                self.tool_requests_containers[message.id] = container
-                s = f"Request to use **{message.name}**\n"
-                for key, value in message.parameters.items():
-                    s += f"{key}: {self.to_inline_or_code_block(value)}\n"
-                st.write(s)
-            else:
+            show = lookup_by_type(self.part_renderers, type(message))
+            if show is None:
                 st.warning(f"Unsupported message type: {type(message)}")
+            else:
+                show(message, container)
+
+            self.show_actions_for(index, pending_requests)
+
+    def show_text(self, message: TextMessage, container):
+        st.write(message.text)
 
-            self.show_actions_for(index)
+    def show_image(self, message: ImageMessage, container):
+        st.warning("Image messages are not supported yet.")
 
-    def show_actions_for(self, index: int):
-        actions = self.actions_for(index)
+    def show_tool_request(self, message: ToolRequestMessage, container):
+        self.tool_requests_containers[message.id] = container
+        cached = self.tool_requests_markdown.get(message.id)
+        if cached is None or cached[0] != message.arguments_json:
+            cached = (message.arguments_json, self.tool_request_markdown(message))
+            self.tool_requests_markdown[message.id] = cached
+        st.write(cached[1])
+
+    def show_actions_for(self, index: int, pending_requests: int | None = None):
+        actions = self.actions_for(index, pending_requests)
         if actions:
-            with st_horizontal():
-                for action in actions:
-                    st.button(
-                        action,
-                        key=f"action_{action}_{index}",
-                        on_click=self.call_action,
-                        args=(action, index),
-                    )
+            key = f"actions_{index}"
+            # A single widget for all the actions of the message, instead of one button each.
+            with st_horizontal(style=False):
+                st.pills(
+                    "Actions",
+                    actions,
+                    key=key,
+                    label_visibility="collapsed",
+                    on_change=self.on_action_selected,
+                    args=(key, index),
+                )
+
+    def on_action_selected(self, key: str, index: int):
+        action = st.session_state[key]
+        # The pills act as buttons, so the selection is cleared right away.
+        st.session_state[key] = None
+        if action is not None:
+            self.call_action(action, index)
 
     def edit_one_parameter(self, key: str, expected_type: pydantic.fields.FieldInfo, value):
 
@@ -338,13 +461,23 @@ class WebChat(ChatBackend):
         return value
 
     def inject_css(self):
-        st.markdown(f"<style>{CSS_FILE.read_text()}</style>", unsafe_allow_html=True)
+        # Streamlit rebuilds the page on every run, so this is sent every run, but only
+        # once, so that st_horizontal() doesn't need to repeat it for every row.
+        st.markdown(page_style(), unsafe_allow_html=True)
+
+    def tool_request_markdown(self, message: ToolRequestMessage) -> str:
+        s = f"Request to use **{message.name}**\n"
+        for key, value in message.parameters.items():
+            s += f"{key}: {self.to_inline_or_code_block(value)}\n"
+        return s
 
     def to_inline_or_code_block(self, value):
-        if "\n" in str(value):
-            return f"\n```\n{value}\n```"
+        # Stringified once, as values can be large.
+        text = value if isinstance(value, str) else str(value)
+        if "\n" in text:
+            return f"\n```\n{text}\n```"
         else:
-            return f"`{value}`"
+            return f"`{text}`"
 
     def show_in_modal(self, **kwargs):
 
@@ -0,0 +1,52 @@
+import asyncio
+import threading
+import weakref
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from chataigne.tool import Tool
+from chataigne.tools import amazing_marvin
+from chataigne.utils import background_loop, run_sync
+
+
+class MarvinHandler(BaseHTTPRequestHandler):
+    # Keep-alive, so that clients reuse their connections, as with Marvin's server.
+    protocol_version = "HTTP/1.1"
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers["Content-Length"]))
+        body = b"{}"
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture
+def marvin_server(monkeypatch):
+    server = ThreadingHTTPServer(("127.0.0.1", 0), MarvinHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    monkeypatch.setattr(amazing_marvin, "BASE", f"http://127.0.0.1:{server.server_port}/api/")
+    monkeypatch.setattr(amazing_marvin, "_clients", weakref.WeakKeyDictionary())
+    yield
+    client = amazing_marvin._clients.get(background_loop())
+    if client is not None:
+        run_sync(client.aclose())
+    server.shutdown()
+    server.server_close()
+
+
+def test_marvin_tool_runs_on_several_event_loops(marvin_server):
+    tool = Tool.from_function(amazing_marvin.add_marvin_task)
+    success = "Task added successfully! 📝"
+
+    assert asyncio.run(tool.arun(title="First")) == success
+    assert asyncio.run(tool.arun(title="Second")) == success
+    # On the background loop, then again on a loop of the caller.
+    assert tool.run(title="Third") == success
+    assert asyncio.run(tool.arun(title="Fourth")) == success
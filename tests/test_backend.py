@@ -0,0 +1,92 @@
+import asyncio
+
+from chataigne.llms import EchoLLM
+from chataigne.messages import (
+    MessageHistory,
+    TextMessage,
+    ToolOutputMessage,
+    ToolRequestMessage,
+)
+from chataigne.web_base import Actions, ChatBackend
+
+
+def make_backend() -> ChatBackend:
+    backend = ChatBackend(MessageHistory([]), EchoLLM())
+
+    @backend.tool
+    async def double(x: int):
+        """Double a number."""
+        return x * 2
+
+    return backend
+
+
+def test_allow_all_runs_pending_requests_concurrently():
+    backend = make_backend()
+    # Each call only returns once both have started: calls run one after the other time out.
+    barrier = asyncio.Barrier(2)
+
+    @backend.tool
+    async def double_together(x: int):
+        """Double a number, once the other call started too."""
+        async with asyncio.timeout(5):
+            await barrier.wait()
+        return x * 2
+
+    backend.messages.extend(
+        [
+            TextMessage(text="Double 1 and 2", is_user=True),
+            ToolRequestMessage(id="a", name="double_together", parameters={"x": 1}),
+            ToolRequestMessage(id="b", name="double_together", parameters={"x": 2}),
+        ]
+    )
+
+    assert Actions.ALLOW_ALL_AND_RUN in backend.actions_for(1)
+
+    backend.call_action(Actions.ALLOW_ALL_AND_RUN, 1)
+
+    assert backend.pending_tool_requests() == []
+    outputs = [m for m in backend.messages if isinstance(m, ToolOutputMessage)]
+    assert [(m.id, m.content) for m in outputs] == [("a", "2"), ("b", "4")]
+    # Each output is right after its request
+    assert backend.messages[2].id == "a"
+    assert backend.messages[4].id == "b"
+
+
+def test_allow_all_is_only_offered_for_several_requests():
+    backend = make_backend()
+    backend.messages.append(ToolRequestMessage(id="a", name="double", parameters={"x": 1}))
+
+    assert Actions.ALLOW_ALL_AND_RUN not in backend.actions_for(0)
+
+
+def test_actions_use_the_given_pending_requests_count():
+    backend = make_backend()
+    backend.messages.extend(
+        [
+            ToolRequestMessage(id="a", name="double", parameters={"x": 1}),
+            ToolRequestMessage(id="b", name="double", parameters={"x": 2}),
+        ]
+    )
+    pending_requests = backend.count_pending_tool_requests()
+    assert pending_requests == 2
+
+    assert backend.actions_for(0, pending_requests) == backend.actions_for(0)
+    assert Actions.ALLOW_ALL_AND_RUN not in backend.actions_for(0, pending_requests=1)
+
+
+def test_delete_request_deletes_its_output():
+    backend = make_backend()
+    backend.messages.extend(
+        [
+            ToolRequestMessage(id="a", name="double", parameters={"x": 1}),
+            ToolRequestMessage(id="b", name="double", parameters={"x": 2}),
+        ]
+    )
+    backend.call_action(Actions.DENY, 0)
+    backend.call_action(Actions.DELETE, 0)
+
+    assert list(backend.messages) == [
+        ToolRequestMessage(id="b", name="double", parameters={"x": 2})
+    ]
+    assert not backend.tool_output_ids()
@@ -0,0 +1,57 @@
+import base64
+
+import PIL.Image
+import pytest
+
+from chataigne.messages import ImageMessage
+
+
+def save_image(path, format: str, size=(8, 4)):
+    PIL.Image.new("RGB", size, "white").save(path, format=format)
+    return path
+
+
+@pytest.mark.parametrize(
+    "format,media_type",
+    [("PNG", "image/png"), ("JPEG", "image/jpeg"), ("GIF", "image/gif"), ("WEBP", "image/webp")],
+)
+def test_from_path_keeps_supported_formats(tmp_path, format, media_type):
+    path = save_image(tmp_path / "image", format)
+
+    message = ImageMessage.from_path(str(path))
+
+    assert message.media_type == media_type
+    assert base64.b64decode(message.base_64) == path.read_bytes()
+
+
+def test_from_path_converts_other_formats_to_png(tmp_path):
+    path = save_image(tmp_path / "image.bmp", "BMP")
+
+    message = ImageMessage.from_path(str(path))
+
+    assert message.media_type == "image/png"
+    assert base64.b64decode(message.base_64).startswith(b"\x89PNG")
+
+
+def test_from_path_downscales_large_images(tmp_path):
+    path = save_image(tmp_path / "image.jpg", "JPEG", size=(400, 100))
+
+    message = ImageMessage.from_path(str(path), max_size=200)
+
+    assert message.media_type == "image/jpeg"
+    assert message.to_anthropic()["content"][0]["source"]["media_type"] == "image/jpeg"
+    decoded = tmp_path / "decoded.jpg"
+    decoded.write_bytes(base64.b64decode(message.base_64))
+    with PIL.Image.open(decoded) as img:
+        assert img.size == (200, 50)
+
+
+def test_data_url_is_cached_until_edited():
+    message = ImageMessage(base_64="abc", media_type="image/jpeg")
+    url = message.data_url
+    assert url == "data:image/jpeg;base64,abc"
+    assert message.data_url is url
+    assert message.to_openai()["content"][0]["image_url"]["url"] is url
+
+    message.base_64 = "def"
+    assert message.data_url == "data:image/jpeg;base64,def"
@@ -0,0 +1,400 @@
+from types import SimpleNamespace
+from typing import AsyncGenerator, cast
+
+import anthropic
+import openai
+import pytest
+
+from chataigne.llms import LLM, AnthropicLLM, OpenAILLM
+from chataigne.messages import (
+    AnyMessagePart,
+    MessageHistory,
+    TextMessage,
+    ToolOutputMessage,
+    ToolRequestMessage,
+)
+from chataigne.tool import Tool
+from chataigne.utils import iter_sync, json_dumps, run_sync
+
+
+class CountingLLM(LLM):
+    def __init__(self, cache: bool):
+        super().__init__("Counting", "counting", cache=cache, cache_size=2)
+        self.calls = 0
+
+    async def _generate(self, system, messages, tools) -> list[AnyMessagePart]:
+        self.calls += 1
+        return [TextMessage(text=f"Answer {self.calls}", is_user=False)]
+
+
+def history(text: str) -> MessageHistory:
+    return MessageHistory([TextMessage(text=text, is_user=True)])
+
+
+def test_identical_calls_are_cached():
+    llm = CountingLLM(cache=True)
+
+    first = run_sync(llm("system", history("Hello"), []))
+    second = run_sync(llm("system", history("Hello"), []))
+
+    assert llm.calls == 1
+    assert first == second
+    assert first[0] is not second[0]
+
+
+def test_cache_depends_on_inputs():
+    llm = CountingLLM(cache=True)
+
+    run_sync(llm("system", history("Hello"), []))
+    run_sync(llm("other system", history("Hello"), []))
+    run_sync(llm("system", history("Goodbye"), []))
+
+    assert llm.calls == 3
+
+
+def test_cache_evicts_least_recently_used():
+    llm = CountingLLM(cache=True)
+
+    run_sync(llm("system", history("1"), []))
+    run_sync(llm("system", history("2"), []))
+    run_sync(llm("system", history("1"), []))
+    run_sync(llm("system", history("3"), []))  # Evicts "2"
+    run_sync(llm("system", history("1"), []))
+    assert llm.calls == 3
+
+    run_sync(llm("system", history("2"), []))
+    assert llm.calls == 4
+
+    llm.cache_clear()
+    run_sync(llm("system", history("1"), []))
+    assert llm.calls == 5
+
+
+def test_no_cache_by_default():
+    llm = CountingLLM(cache=False)
+
+    run_sync(llm("system", history("Hello"), []))
+    run_sync(llm("system", history("Hello"), []))
+
+    assert llm.calls == 2
+
+
+def test_disabled_tools_are_not_sent():
+    seen = []
+
+    class ToolsLLM(LLM):
+        async def _generate(self, system, messages, tools):
+            seen.extend(tools)
+            return []
+
+    def add(x: int, y: int):
+        """Add two numbers"""
+        return x + y
+
+    def sub(x: int, y: int):
+        """Subtract two numbers"""
+        return x - y
+
+    enabled = Tool.from_function(add)
+    disabled = Tool.from_function(sub)
+    disabled.enabled = False
+
+    run_sync(ToolsLLM("Tools", "tools")("system", history("Hello"), [enabled, disabled]))
+    assert seen == [enabled]
+
+
+class StreamingLLM(LLM):
+    def __init__(self):
+        super().__init__("Streaming", "streaming", cache=True)
+
+    async def _stream(self, system, messages, tools) -> AsyncGenerator[str | AnyMessagePart, None]:
+        yield "Hel"
+        yield "lo"
+        yield TextMessage(text="Hello", is_user=False)
+
+
+async def collect(stream):
+    return [item async for item in stream]
+
+
+def test_stream_yields_deltas_then_parts():
+    llm = StreamingLLM()
+
+    items = run_sync(collect(llm.stream("system", history("Hi"), [])))
+    assert items == ["Hel", "lo", TextMessage(text="Hello", is_user=False)]
+
+    # Answered from the cache, without deltas
+    items = run_sync(collect(llm.stream("system", history("Hi"), [])))
+    assert items == [TextMessage(text="Hello", is_user=False)]
+
+
+def test_call_only_returns_parts():
+    assert run_sync(StreamingLLM()("system", history("Hi"), [])) == [
+        TextMessage(text="Hello", is_user=False)
+    ]
+
+
+def test_llm_without_implementation_raises():
+    with pytest.raises(NotImplementedError):
+        LLM("a", "b").call_sync("system", history("Hello"), [])
+
+
+class CallOnlyLLM(LLM):
+    async def __call__(self, system, messages, tools) -> list[AnyMessagePart]:
+        return [TextMessage(text="Called", is_user=False)]
+
+
+def test_overridden_call_is_streamed():
+    llm = CallOnlyLLM("Call only", "call-only")
+    parts = run_sync(collect(llm.stream("system", history("Hello"), [])))
+    assert parts == [TextMessage(text="Called", is_user=False)]
+
+
+class SyncCallLLM(LLM):
+    def __call__(self, system, messages, tools):  # type: ignore
+        return [TextMessage(text="Called", is_user=False)]
+
+
+def test_overridden_sync_call_still_works():
+    llm = SyncCallLLM("Sync call", "sync-call")
+    expected = [TextMessage(text="Called", is_user=False)]
+
+    assert run_sync(collect(llm.stream("system", history("Hello"), []))) == expected
+    assert llm.call_sync("system", history("Hello"), []) == expected
+    assert run_sync(llm.batch_call("system", [history("1")], [])) == [expected]
+
+
+def text_delta(text: str) -> SimpleNamespace:
+    return SimpleNamespace(content=text, tool_calls=None)
+
+
+def tool_call_delta(
+    index: int, id: str | None = None, name: str | None = None, arguments: str | None = None
+) -> SimpleNamespace:
+    function = SimpleNamespace(name=name, arguments=arguments)
+    return SimpleNamespace(index=index, id=id, function=function)
+
+
+def tool_calls_delta(*calls: SimpleNamespace) -> SimpleNamespace:
+    return SimpleNamespace(content=None, tool_calls=list(calls))
+
+
+class FakeOpenAIStream:
+    def __init__(self, deltas: list[SimpleNamespace]):
+        self.deltas = deltas
+        self.closed = False
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        self.closed = True
+
+    async def __aiter__(self):
+        for delta in self.deltas:
+            yield SimpleNamespace(choices=[SimpleNamespace(delta=delta)])
+
+
+def fake_openai_llm(stream: FakeOpenAIStream) -> OpenAILLM:
+    async def create(**kwargs):
+        return stream
+
+    fake_client = SimpleNamespace(chat=SimpleNamespace(completions=SimpleNamespace(create=create)))
+
+    class FakeOpenAILLM(OpenAILLM):
+        @property
+        def client(self) -> openai.AsyncOpenAI:
+            return cast(openai.AsyncOpenAI, fake_client)
+
+    return FakeOpenAILLM("Fake", "fake")
+
+
+def test_openai_stream_is_closed_when_stopped_early():
+    stream = FakeOpenAIStream([text_delta("Hel"), text_delta("lo")])
+
+    llm = fake_openai_llm(stream)
+    for delta in iter_sync(llm.stream("system", history("Hello"), [])):
+        assert delta == "Hel"
+        break
+
+    assert stream.closed
+
+
+def test_openai_stream_interleaves_text_and_tool_call():
+    stream = FakeOpenAIStream(
+        [
+            text_delta("Let me "),
+            tool_calls_delta(tool_call_delta(0, id="a", name="add", arguments='{"x":')),
+            text_delta("check."),
+            tool_calls_delta(tool_call_delta(0, arguments=" 1}")),
+        ]
+    )
+
+    items = run_sync(collect(fake_openai_llm(stream).stream("system", history("Hi"), [])))
+
+    assert items == [
+        "Let me ",
+        "check.",
+        TextMessage(text="Let me check.", is_user=False),
+        ToolRequestMessage(name="add", parameters={"x": 1}, id="a"),
+    ]
+
+
+def test_openai_stream_reassembles_parallel_tool_calls():
+    stream = FakeOpenAIStream(
+        [
+            tool_calls_delta(tool_call_delta(0, id="a", name="add", arguments='{"x"')),
+            tool_calls_delta(tool_call_delta(1, id="b", name="sub", arguments='{"y":')),
+            tool_calls_delta(
+                tool_call_delta(0, arguments=": 1}"),
+                tool_call_delta(1, arguments=" 2}"),
+            ),
+        ]
+    )
+
+    items = run_sync(collect(fake_openai_llm(stream).stream("system", history("Hi"), [])))
+
+    assert items == [
+        ToolRequestMessage(name="add", parameters={"x": 1}, id="a"),
+        ToolRequestMessage(name="sub", parameters={"y": 2}, id="b"),
+    ]
+
+
+class FakeAnthropicStream:
+    def __init__(self, texts: list[str], content: list[SimpleNamespace]):
+        self.texts = texts
+        self.content = content
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        pass
+
+    @property
+    async def text_stream(self):
+        for text in self.texts:
+            yield text
+
+    async def get_final_message(self):
+        return SimpleNamespace(content=self.content)
+
+
+def fake_anthropic_llm(stream: FakeAnthropicStream, requests: list[dict]) -> AnthropicLLM:
+    def messages_stream(**kwargs):
+        requests.append(kwargs)
+        return stream
+
+    fake_client = SimpleNamespace(messages=SimpleNamespace(stream=messages_stream))
+
+    class FakeAnthropicLLM(AnthropicLLM):
+        @property
+        def client(self) -> anthropic.AsyncAnthropic:
+            return cast(anthropic.AsyncAnthropic, fake_client)
+
+    return FakeAnthropicLLM("Fake", "fake")
+
+
+def test_anthropic_request_marks_the_stable_prefix_for_caching():
+    def add(x: int, y: int):
+        """Add two numbers"""
+        return x + y
+
+    def sub(x: int, y: int):
+        """Subtract two numbers"""
+        return x - y
+
+    tools = [Tool.from_function(add), Tool.from_function(sub)]
+    messages = MessageHistory(
+        [
+            TextMessage(text="What is 1 + 2?", is_user=True),
+            ToolRequestMessage(name="add", parameters={"x": 1, "y": 2}, id="1"),
+            ToolOutputMessage(name="add", content="3", id="1"),
+        ]
+    )
+    requests = []
+    llm = fake_anthropic_llm(FakeAnthropicStream([], []), requests)
+
+    run_sync(llm("system", messages, tools))
+
+    [request] = requests
+    ephemeral = {"type": "ephemeral"}
+    assert request["system"] == [{"type": "text", "text": "system", "cache_control": ephemeral}]
+    assert "cache_control" not in request["tools"][0]
+    assert request["tools"][-1]["cache_control"] == ephemeral
+    assert request["messages"][-2]["content"][-1]["cache_control"] == ephemeral
+    assert "cache_control" not in request["messages"][-1]["content"][-1]
+    assert request["extra_headers"] == {"anthropic-beta": "prompt-caching-2024-07-31"}
+
+    # The marks are on copies, not on the cached dicts of the history and tools.
+    assert "cache_control" not in json_dumps(messages.to_anthropic())
+    assert all("cache_control" not in tool.to_anthropic() for tool in tools)
+
+
+def test_anthropic_stream_yields_text_then_text_and_tool_use():
+    content = [
+        SimpleNamespace(type="text", text="Adding."),
+        SimpleNamespace(type="tool_use", name="add", input={"x": 1, "y": 2}, id="t1"),
+    ]
+    llm = fake_anthropic_llm(FakeAnthropicStream(["Add", "ing."], content), [])
+
+    items = run_sync(collect(llm.stream("system", history("1 + 2?"), [])))
+
+    assert items == [
+        "Add",
+        "ing.",
+        TextMessage(text="Adding.", is_user=False),
+        ToolRequestMessage(name="add", parameters={"x": 1, "y": 2}, id="t1"),
+    ]
+
+
+def test_anthropic_request_without_system_prompt():
+    requests = []
+    llm = fake_anthropic_llm(FakeAnthropicStream([], []), requests)
+
+    run_sync(llm("", history("Hello"), []))
+
+    assert requests[0]["system"] is anthropic.NOT_GIVEN
+
+
+class BatchAnsweringLLM(LLM):
+    def __init__(self, reply: str):
+        super().__init__("Batch", "batch")
+        self.reply = reply
+        self.prompts = []
+
+    async def _generate(self, system, messages, tools) -> list[AnyMessagePart]:
+        self.prompts.append(messages[-1].text)
+        if len(messages) == 1 and messages[0].text.startswith("Q[1]"):
+            return [TextMessage(text=self.reply, is_user=False)]
+        return [TextMessage(text=f"Single: {messages[-1].text}", is_user=False)]
+
+
+def test_batch_call_packs_single_questions():
+    llm = BatchAnsweringLLM("A[1]: Paris\nA[2]: Two\nlines")
+
+    answers = run_sync(llm.batch_call("system", [history("France?"), history("Two?")], []))
+
+    assert len(llm.prompts) == 1
+    assert llm.prompts[0].startswith("Q[1]: France?\nQ[2]: Two?\n")
+    assert answers == [
+        [TextMessage(text="Paris", is_user=False)],
+        [TextMessage(text="Two\nlines", is_user=False)],
+    ]
+
+
+def test_batch_call_falls_back_to_single_calls():
+    llm = BatchAnsweringLLM("A[1]: Only one answer")
+
+    answers = run_sync(llm.batch_call("system", [history("1"), history("2")], []))
+
+    assert len(llm.prompts) == 3
+    assert answers == [
+        [TextMessage(text="Single: 1", is_user=False)],
+        [TextMessage(text="Single: 2", is_user=False)],
+    ]
+
+
+def test_providers_accept_cache_size():
+    assert OpenAILLM("GPT", "gpt", cache=True, cache_size=3).cache_size == 3
+    assert AnthropicLLM("Claude", "claude", cache=True, cache_size=3).cache_size == 3
@@ -68,3 +68,25 @@ def test_merge_empty_dict():
     b = {}
     result = merge(a, b)
     assert result == {"key1": "value1"}
+
+
+def test_merge_nested_lists():
+    a = {"key1": {"subkey1": [1]}}
+    b = {"key1": {"subkey1": [2], "subkey2": [3]}}
+    result = merge(a, b)
+    assert result == {"key1": {"subkey1": [1, 2], "subkey2": [3]}}
+
+
+def test_merge_does_not_modify_inputs():
+    a = {"key1": {"subkey1": [1]}}
+    b = {"key1": {"subkey1": [2]}}
+    merge(a, b)
+    assert a == {"key1": {"subkey1": [1]}}
+    assert b == {"key1": {"subkey1": [2]}}
+
+
+def test_merge_nested_dict_and_list():
+    a = {"key1": {"subkey1": "subvalue1"}}
+    b = {"key1": ["subvalue2"]}
+    with pytest.raises(ValueError):
+        merge(a, b)
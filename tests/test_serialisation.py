@@ -5,6 +5,7 @@ from chataigne.messages import (
     MessageHistory,
     MessagePart,
     TextMessage,
+    ToolOutputMessage,
     ToolRequestMessage,
 )
 
@@ -44,7 +45,7 @@ def test_message_history_serialise_and_back():
     expected = [
         {"type": "text", "text": "User message 1", "is_user": True},
         {"type": "text", "text": "Assistant message 1", "is_user": False},
-        {"type": "image", "base_64": "image=="},
+        {"type": "image", "base_64": "image==", "media_type": "image/png"},
         {
             "type": "toolrequest",
             "name": "tool_1",
@@ -56,3 +57,126 @@ def test_message_history_serialise_and_back():
     result = messages.model_dump()
 
     assert result == expected
+
+
+def test_serialisation_is_cached_until_edited():
+    message = TextMessage(text="Hello", is_user=True)
+
+    first = message.to_openai()
+    assert message.to_openai() is first
+
+    message.text = "Goodbye"
+    assert message.to_openai() == {
+        "role": "user",
+        "content": [{"type": "text", "text": "Goodbye"}],
+    }
+
+
+def test_cache_is_ignored_by_equality_and_dump():
+    message = ToolRequestMessage(name="tool_1", parameters={"param1": "value1"}, id="1")
+    other = message.model_copy()
+    message.to_anthropic()
+
+    assert message == other
+    assert message.model_dump() == other.model_dump()
+
+
+def test_message_history_does_not_share_the_list():
+    parts = [TextMessage(text="User message 1", is_user=True)]
+    messages = MessageHistory(parts)
+    messages.append(TextMessage(text="Assistant message 1", is_user=False))
+
+    assert len(parts) == 1
+    assert MessageHistory.model_validate(messages.model_dump()) == messages
+
+
+def test_message_history_json_round_trip():
+    messages = MessageHistory(
+        [
+            TextMessage(text="User message 1", is_user=True),
+            ImageMessage(base_64="image==", media_type="image/jpeg"),
+            ToolRequestMessage(name="tool_1", parameters={"param1": [1, 2]}, id="1"),
+            ToolOutputMessage(id="1", name="tool_1", content="output", canceled=True),
+        ]
+    )
+
+    assert MessageHistory.model_validate_json(messages.model_dump_json()) == messages
+
+
+def test_message_history_indexes_tool_ids():
+    request = ToolRequestMessage(name="tool_1", parameters={}, id="1")
+    output = ToolOutputMessage(name="tool_1", content="done", id="1")
+    history = MessageHistory([request])
+    assert set(history.tool_request_ids()) == {"1"}
+    assert not history.tool_output_ids()
+
+    history.insert(1, output)
+    history.extend([ToolRequestMessage(name="tool_1", parameters={}, id="2")])
+    assert set(history.tool_request_ids()) == {"1", "2"}
+    assert set(history.tool_output_ids()) == {"1"}
+
+    history.pop(1)
+    history.remove(request)
+    assert set(history.tool_request_ids()) == {"2"}
+    assert not history.tool_output_ids()
+
+
+@pytest.mark.parametrize(
+    "message",
+    [
+        TextMessage(text="User message", is_user=True),
+        TextMessage(text="Assistant message", is_user=False),
+        ImageMessage(base_64="image"),
+        ToolRequestMessage(name="tool_1", parameters={}, id="1"),
+        ToolOutputMessage(name="tool_1", content="done", id="1"),
+    ],
+)
+def test_role_matches_openai(message: MessagePart):
+    assert message.role == message.to_openai()["role"]
+
+
+def test_arguments_json_is_cached_until_edited():
+    message = ToolRequestMessage(name="tool_1", parameters={"a": 1}, id="1")
+    assert message.arguments_json == '{"a":1}'
+    assert message.arguments_json is message.arguments_json
+
+    # Only assignments clear the cache, see MessagePart.
+    message.parameters["a"] = 3
+    assert message.arguments_json == '{"a":1}'
+
+    message.parameters = {"a": 2}
+    assert message.arguments_json == '{"a":2}'
+    assert message.to_openai()["tool_calls"][0]["function"]["arguments"] == '{"a":2}'
+
+
+def test_arguments_json_is_compact_and_keeps_unicode():
+    message = ToolRequestMessage(name="weather", parameters={"city": "Zürich", "days": 2}, id="1")
+    assert message.arguments_json == '{"city":"Zürich","days":2}'
+
+
+def test_arguments_json_with_big_integers():
+    message = ToolRequestMessage(name="add", parameters={"x": 10**20}, id="1")
+    MessageHistory([message]).to_openai()
+    assert message.arguments_json == '{"x":100000000000000000000}'
+
+
+def test_equality_compares_fields_and_types():
+    message = TextMessage(text="Hello", is_user=True)
+    message.to_openai()
+
+    assert message == TextMessage(text="Hello", is_user=True)
+    assert message != TextMessage(text="Hello", is_user=False)
+    assert message != ToolOutputMessage(id="1", name="Hello", content="Hello")
+    assert message != "Hello"
+
+
+def test_conversions_are_shared_and_only_refreshed_on_assignment():
+    message = ToolRequestMessage(name="add", parameters={"x": 1}, id="1")
+    assert message.to_openai() is message.to_openai()
+
+    # Not supported: in-place edits don't clear the cache.
+    message.parameters["x"] = 2
+    assert message.to_openai()["tool_calls"][0]["function"]["arguments"] == '{"x":1}'
+
+    message.parameters = {"x": 2}
+    assert message.to_openai()["tool_calls"][0]["function"]["arguments"] == '{"x":2}'
@@ -1,4 +1,3 @@
-import anthropic
 import pytest
 
 from chataigne.messages import (
@@ -34,6 +33,27 @@ user_assistant_user_text_messages = (
         {"role": "user", "content": [{"type": "text", "text": "Goodbye"}]},
     ],
 )
+consecutive_text_messages_from_the_same_side = (
+    [
+        TextMessage(text="Hello", is_user=True),
+        TextMessage(text="Are you there?", is_user=True),
+        TextMessage(text="Yes", is_user=False),
+        TextMessage(text="Hi", is_user=False),
+    ],
+    [
+        {
+            "role": "user",
+            "content": [
+                {"type": "text", "text": "Hello"},
+                {"type": "text", "text": "Are you there?"},
+            ],
+        },
+        {
+            "role": "assistant",
+            "content": [{"type": "text", "text": "Yes"}, {"type": "text", "text": "Hi"}],
+        },
+    ],
+)
 user_text_and_image_message = (
     [TextMessage(text="Hello", is_user=True), ImageMessage(base_64=image)],
     [
@@ -214,6 +234,7 @@ tool_request_before_assistant_message = (
         single_user_text_message,
         single_assistant_text_message,
         user_assistant_user_text_messages,
+        consecutive_text_messages_from_the_same_side,
         # user_text_and_image_message,
         # assistant_text_and_tool_request_message,
         # mixed_messages,
@@ -226,6 +247,23 @@ def test_to_anthropic(messages, expected_result):
     assert result == expected_result
 
 
+class QuotedTextMessage(TextMessage):
+    pass
+
+
+@pytest.mark.parametrize(
+    "messages,expected_result",
+    [user_assistant_user_text_messages, consecutive_text_messages_from_the_same_side],
+)
+def test_to_anthropic_accepts_subclasses(messages, expected_result):
+    messages = [
+        QuotedTextMessage(text=m.text, is_user=m.is_user) if type(m) is TextMessage else m
+        for m in messages
+    ]
+    result = MessageHistory(messages).to_anthropic()
+    assert result == expected_result
+
+
 @pytest.mark.xfail
 @pytest.mark.parametrize(
     "messages,expected_result",
@@ -256,6 +294,9 @@ def test_to_anthropic_fails(messages, expected_result):
     ],
 )
 def test_anthropic_accepts_messages(messages):
+    # Imported here, as the SDK is slow to import and only needed by this test.
+    import anthropic
+
     messages = messages[1]
 
     anthropic.chat.completions.create(
@@ -1,4 +1,3 @@
-import openai
 import pytest
 
 from chataigne.messages import (
@@ -47,7 +46,7 @@ assistant_text_and_tool_request_message = (
                 {
                     "id": "1",
                     "type": "function",
-                    "function": {"name": "tool_name", "arguments": '{"param": "value"}'},
+                    "function": {"name": "tool_name", "arguments": '{"param":"value"}'},
                 }
             ],
         }
@@ -76,7 +75,7 @@ mixed_messages = (
                 {
                     "id": "1",
                     "type": "function",
-                    "function": {"name": "tool_name", "arguments": '{"param": "value"}'},
+                    "function": {"name": "tool_name", "arguments": '{"param":"value"}'},
                 }
             ],
         },
@@ -105,7 +104,7 @@ multiple_user_and_assistant_messages_with_tools = (
                 {
                     "id": "1",
                     "type": "function",
-                    "function": {"name": "tool_1", "arguments": '{"param1": "value1"}'},
+                    "function": {"name": "tool_1", "arguments": '{"param1":"value1"}'},
                 }
             ],
         },
@@ -120,7 +119,7 @@ multiple_user_and_assistant_messages_with_tools = (
                 {
                     "id": "2",
                     "type": "function",
-                    "function": {"name": "tool_2", "arguments": '{"param2": "value2"}'},
+                    "function": {"name": "tool_2", "arguments": '{"param2":"value2"}'},
                 }
             ],
         },
@@ -151,7 +150,7 @@ interleaved_messages_with_different_types = (
                 {
                     "id": "1",
                     "type": "function",
-                    "function": {"name": "tool_1", "arguments": '{"param1": "value1"}'},
+                    "function": {"name": "tool_1", "arguments": '{"param1":"value1"}'},
                 }
             ],
         },
@@ -168,7 +167,7 @@ interleaved_messages_with_different_types = (
                 {
                     "id": "2",
                     "type": "function",
-                    "function": {"name": "tool_2", "arguments": '{"param2": "value2"}'},
+                    "function": {"name": "tool_2", "arguments": '{"param2":"value2"}'},
                 }
             ],
         },
@@ -187,7 +186,7 @@ tool_request_before_assistant_message = (
                 {
                     "id": "1",
                     "type": "function",
-                    "function": {"name": "tool_1", "arguments": '{"param1": "value1"}'},
+                    "function": {"name": "tool_1", "arguments": '{"param1":"value1"}'},
                 }
             ],
         }
@@ -213,6 +212,23 @@ def test_to_openai(messages, expected_result):
     assert result == expected_result
 
 
+class QuotedTextMessage(TextMessage):
+    pass
+
+
+@pytest.mark.parametrize(
+    "messages,expected_result",
+    [user_text_and_image_message, assistant_text_and_tool_request_message],
+)
+def test_to_openai_accepts_subclasses(messages, expected_result):
+    messages = [
+        QuotedTextMessage(text=m.text, is_user=m.is_user) if type(m) is TextMessage else m
+        for m in messages
+    ]
+    result = MessageHistory(messages).to_openai()
+    assert result == expected_result
+
+
 @pytest.mark.xfail
 @pytest.mark.parametrize(
     "messages,expected_result",
@@ -242,6 +258,9 @@ def test_to_openai_fails(messages, expected_result):
     ],
 )
 def test_openai_accepts_messages(messages):
+    # Imported here, as the SDK is slow to import and only needed by this test.
+    import openai
+
     messages = messages[1]
 
     openai.chat.completions.create(
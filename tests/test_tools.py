@@ -1,14 +1,127 @@
-from chataigne.tool import create_model_from_function
+import asyncio
+import gc
+import threading
+import weakref
 
+from chataigne.tool import Tool, create_model_from_function
+from chataigne.utils import run_sync
+
+
+def custom_add(a: int, b: float = 2):
+    """Add two numbers"""
+    return a + b * 2
 
-def test_create_model_from_function():
-    def custom_add(a: int, b: float = 2):
-        """Add two numbers"""
-        return a + b * 2
 
+def test_create_model_from_function():
     model = create_model_from_function(custom_add)
     instance = model(a=1, b=4.0)
     assert instance.model_dump() == {"a": 1, "b": 4.0}
     shema = model.model_json_schema()
     assert shema["required"] == ["a"]
     assert list(shema["properties"]) == ["a", "b"]
+
+
+def test_tool_from_async_function():
+    async def custom_add(a: int, b: float = 2):
+        """Add two numbers"""
+        await asyncio.sleep(0)
+        return a + b * 2
+
+    tool = Tool.from_function(custom_add)
+    assert tool.run(a=1, b=4.0) == "9.0"
+
+
+def test_tool_schema_is_cached():
+    tool = Tool.from_function(custom_add)
+    schema = tool.to_openai()
+    assert tool.to_anthropic()["input_schema"] is schema["function"].get("parameters")
+
+    tool.enabled = False
+    assert tool.to_openai() is schema
+
+    tool.description = "Add numbers"
+    assert tool.to_openai()["function"].get("description") == "Add numbers"
+
+
+def test_tool_copy_has_its_own_cache():
+    tool = Tool.from_function(custom_add)
+    tool.to_openai()
+
+    updated = tool.model_copy(update={"description": "Add numbers"})
+    assert updated.to_openai()["function"].get("description") == "Add numbers"
+
+    renamed = tool.model_copy()
+    renamed.name = "add"
+    assert renamed.to_openai()["function"]["name"] == "add"
+    assert tool.to_openai()["function"]["name"] == "custom_add"
+
+
+def test_tool_schema_without_required_parameters():
+    def greet(name: str = "world"):
+        """Say hello"""
+        return f"Hello {name}"
+
+    tool = Tool.from_function(greet)
+    assert tool.shema() == {
+        "type": "object",
+        "properties": {"name": {"default": "world", "title": "Name", "type": "string"}},
+        "required": [],
+    }
+
+
+def test_tool_run_validates_arguments():
+    tool = Tool.from_function(custom_add)
+    assert tool.run(a="1", b="4") == "9.0"
+
+    output = tool.run(a="one")
+    assert output.startswith("Invalid arguments for custom_add")
+    assert "a\n" in output
+
+
+def test_tool_arun_runs_sync_functions_in_a_thread():
+    def current_thread():
+        """Name of the thread running the tool"""
+        return threading.current_thread().name
+
+    tool = Tool.from_function(current_thread)
+    assert run_sync(tool.arun()) != threading.current_thread().name
+    assert tool.run() == threading.current_thread().name
+
+
+def test_model_is_cached_per_function():
+    def other_add(a: int, b: float = 2):
+        """Add two numbers"""
+        return a + b * 2
+
+    model = create_model_from_function(custom_add)
+    assert create_model_from_function(custom_add) is model
+    assert create_model_from_function(other_add) is not model
+
+
+def test_model_cache_does_not_keep_functions_alive():
+    def custom_add(a: int, b: float = 2):
+        """Add two numbers"""
+        return a + b * 2
+
+    create_model_from_function(custom_add)
+    ref = weakref.ref(custom_add)
+    del custom_add
+    gc.collect()
+    assert ref() is None
+
+
+class SlottedDouble:
+    """Double a number"""
+
+    # Without __weakref__, instances can't be weakly referenced.
+    __slots__ = ()
+    __name__ = "double"
+
+    def __call__(self, x: int):
+        return x * 2
+
+
+def test_model_from_callable_without_weak_references():
+    model = create_model_from_function(SlottedDouble())
+    assert model(x=2).model_dump() == {"x": 2}
+    assert Tool.from_function(SlottedDouble()).run(x=2) == "4"
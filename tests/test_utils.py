@@ -0,0 +1,81 @@
+import asyncio
+
+import pytest
+
+from chataigne.utils import (
+    background_loop,
+    iter_sync,
+    json_dumps,
+    json_loads,
+    lookup_by_type,
+    run_sync,
+)
+
+
+def test_run_sync_returns_result():
+    async def double(x: int) -> int:
+        await asyncio.sleep(0)
+        return 2 * x
+
+    assert run_sync(double(21)) == 42
+
+
+def test_run_sync_always_uses_the_same_loop():
+    async def current_loop():
+        return asyncio.get_running_loop()
+
+    assert run_sync(current_loop()) is run_sync(current_loop()) is background_loop()
+
+
+def test_run_sync_from_background_loop_raises():
+    async def nested():
+        return run_sync(asyncio.sleep(0))
+
+    with pytest.raises(RuntimeError):
+        run_sync(nested())
+
+
+def test_json_dumps_is_compact():
+    data = {"a": [1, 2.5, None], "b": "été"}
+    assert json_dumps(data) == '{"a":[1,2.5,null],"b":"été"}'
+    assert json_loads(json_dumps(data)) == data
+
+
+def test_json_dumps_big_integers():
+    assert json_dumps({"x": 10**20}) == '{"x":100000000000000000000}'
+    assert json_dumps([-(2**64)], indent=True) == "[\n  -18446744073709551616\n]"
+
+
+def test_json_loads_big_integers():
+    assert json_loads('{"x":100000000000000000001}') == {"x": 10**20 + 1}
+    assert json_loads(b"[-18446744073709551617, 1]") == [-(2**64) - 1, 1]
+
+
+def test_iter_sync_yields_and_closes():
+    closed = []
+
+    async def numbers():
+        try:
+            for i in range(3):
+                await asyncio.sleep(0)
+                yield i
+        finally:
+            closed.append(True)
+
+    assert list(iter_sync(numbers())) == [0, 1, 2]
+
+    for i in iter_sync(numbers()):
+        break
+    assert closed == [True, True]
+
+
+def test_json_dumps_indent():
+    assert json_dumps({"a": [1]}, indent=True) == '{\n  "a": [\n    1\n  ]\n}'
+
+
+def test_lookup_by_type_falls_back_to_base_classes():
+    table = {int: "int", object: "object"}
+    assert lookup_by_type(table, int) == "int"
+    assert lookup_by_type(table, bool) == "int"
+    assert lookup_by_type(table, str) == "object"
+    assert lookup_by_type({int: "int"}, str) is None